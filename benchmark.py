@@ -0,0 +1,342 @@
+#!/usr/bin/python
+
+# Benchmarks the bot's handlers and jobs against a local Postgres filled with
+# synthetic users and history. Handlers are driven through fake bot and update
+# objects, so nothing is sent to Telegram. Each case reports p50/p95/p99
+# latency, queries per call and peak Python memory, and the results are
+# written out as JSON so runs can be compared.
+#
+#   python benchmark.py --users 1000 --days 730 --output results.json
+#
+# Connection settings come from creds.ini, but the data goes into a separate
+# database (DB_NAME + "_benchmark" unless --db-name is given), which is
+# created if it doesn't exist yet.
+
+import argparse
+import datetime
+import io
+import json
+import random
+import subprocess
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import psycopg2
+import psycopg2.extensions
+
+import bot
+
+QUERIES_LOCK = threading.Lock()
+QUERY_COUNT = [0]
+
+# Counts every statement sent to Postgres, including the PREPARE and EXECUTE
+# pairs of prepared statements
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        with QUERIES_LOCK:
+            QUERY_COUNT[0] += 1
+        return super().execute(query, vars)
+
+def counting_cursor(self, *args, **kwargs):
+    if not args and "name" not in kwargs:
+        kwargs.setdefault("cursor_factory", CountingCursor)
+    return psycopg2.extensions.connection.cursor(self, *args, **kwargs)
+
+def query_count():
+    with QUERIES_LOCK:
+        return QUERY_COUNT[0]
+
+# Stands in for telegram.Bot, recording calls instead of making them
+class FakeBot:
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self, **kwargs):
+        photo = kwargs.get("photo")
+        if hasattr(photo, "read"):
+            photo.read()
+        with self._lock:
+            self.calls += 1
+            message_id = self.calls
+        return SimpleNamespace(message_id=message_id, photo=[SimpleNamespace(file_id="benchmark-{}".format(message_id))])
+
+    send_message = _call
+    send_photo = _call
+    send_document = _call
+    delete_message = _call
+
+def fake_update(user_id, text):
+    user = SimpleNamespace(id=user_id, first_name="User{}".format(user_id), last_name=None, username=None,
+                           full_name="User{}".format(user_id))
+    chat = SimpleNamespace(id=user_id, type="private")
+    message = SimpleNamespace(text=text, from_user=user, chat=chat, chat_id=user_id, message_id=1,
+                              date=datetime.datetime.now())
+    return SimpleNamespace(message=message, effective_user=user, effective_chat=chat)
+
+# Connects with the settings in `parser`, by default the bot's own creds.ini
+def create_database(name, parser=None):
+    parser = parser or bot.PARSER
+    connection = psycopg2.connect(dbname="postgres", user=parser.get('DEFAULT', 'DB_USER'),
+                                  password=parser.get('DEFAULT', 'DB_PASSWORD'),
+                                  host=parser.get('DEFAULT', 'DB_HOST'),
+                                  port=parser.get('DEFAULT', 'DB_PORT', fallback="5432"))
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+        if cursor.fetchone() is None:
+            cursor.execute("CREATE DATABASE {}".format(psycopg2.extensions.quote_ident(name, cursor)))
+    connection.close()
+
+def copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(str(value) for value in row) + "\n")
+    buffer.seek(0)
+    cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)), buffer)
+
+# Fills the database with `users` users and `days` days of history. Each user
+# gets their own habits, so streaks, sums and averages all vary.
+def seed(users, days, subscribers, reminder_users):
+    rng = random.Random(20180323)
+    today = datetime.date.today()
+    started = time.perf_counter()
+
+    with bot.transaction() as cursor:
+        cursor.execute("TRUNCATE users, meditation, meditationreminders, anxiety, sleep, fasting, happiness, "
+                       "journal, exercise, done, summary, streaks, emailoutbox, dailyrollups, grouprollups")
+        copy_rows(cursor, "users", ("id", "first_name", "haspm"),
+                  ((user_id, "User{}".format(user_id), "t") for user_id in range(1, users + 1)))
+
+    for user_id in range(1, users + 1):
+        diligence = rng.random()
+        rows = {table: [] for table in ("meditation", "sleep", "anxiety", "happiness", "fasting", "journal", "exercise")}
+        for days_ago in range(days):
+            day = today - datetime.timedelta(days=days_ago)
+            def at(hour):
+                return datetime.datetime.combine(day, datetime.time(hour, rng.randrange(60), rng.randrange(60)))
+            if rng.random() < diligence:
+                rows["meditation"].append((user_id, rng.choice((5, 10, 15, 20, 30, 45, 60)), at(rng.randrange(6, 23))))
+            if rng.random() < diligence * 0.8:
+                rows["sleep"].append((user_id, rng.choice((5.5, 6, 6.5, 7, 7.5, 8, 9)), at(8)))
+            if rng.random() < diligence * 0.5:
+                rows["happiness"].append((user_id, rng.randrange(11), at(rng.randrange(8, 22))))
+                rows["anxiety"].append((user_id, rng.randrange(11), at(rng.randrange(8, 22))))
+            if rng.random() < diligence * 0.2:
+                rows["fasting"].append((user_id, rng.choice((12, 16, 18.5, 24)), at(12)))
+            if rng.random() < diligence * 0.3:
+                rows["journal"].append((user_id, "Felt calm after a long sit, noticed the breath slowing", at(21)))
+            if rng.random() < diligence * 0.4:
+                rows["exercise"].append((user_id, rng.choice(("run 5km", "yoga", "swim", "rest")), at(18)))
+
+        with bot.transaction() as cursor:
+            for table, table_rows in rows.items():
+                copy_rows(cursor, table, ("id", "value", "created_at"), table_rows)
+
+    with bot.transaction() as cursor:
+        copy_rows(cursor, "summary", ("id", "email"),
+                  ((user_id, "user{}@example.com".format(user_id)) for user_id in range(1, subscribers + 1)))
+        copy_rows(cursor, "meditationreminders", ("id", "value", "midnight"),
+                  ((user_id, rng.randrange(24), rng.randrange(24)) for user_id in range(1, reminder_users + 1)))
+        bot.rebuild_streaks(cursor)
+        bot.backfill_rollups(cursor)
+        bot.backfill_group_rollups(cursor)
+        cursor.execute("ANALYZE")
+
+    return time.perf_counter() - started
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+# Runs a handler call and waits for everything it set off: charts being
+# rendered and sent, and the outbox draining. Returns whether it succeeded.
+def run_to_completion(call):
+    futures = []
+    generate_graph = bot.generate_graph
+
+    def tracking_generate_graph(*args, **kwargs):
+        future = generate_graph(*args, **kwargs)
+        if future is not None:
+            futures.append(future)
+        return future
+
+    bot.generate_graph = tracking_generate_graph
+    succeeded = True
+    try:
+        call()
+    except Exception as error:
+        print("  {}: {}".format(type(error).__name__, error))
+        succeeded = False
+    finally:
+        bot.generate_graph = generate_graph
+
+    for future in futures:
+        # Registered after the handler's own callback, so this fires once
+        # the chart has been handed to the outbox
+        done = threading.Event()
+        future.add_done_callback(lambda _: done.set())
+        done.wait()
+        succeeded = succeeded and future.exception() is None
+    bot.OUTBOX.wait_until_empty()
+    return succeeded
+
+def measure(name, call, iterations, setup=None):
+    timings = []
+    queries = []
+    errors = 0
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        before = query_count()
+        started = time.perf_counter()
+        if not run_to_completion(call):
+            errors += 1
+        timings.append(time.perf_counter() - started)
+        queries.append(query_count() - before)
+
+    # One more run under tracemalloc, which slows everything down too much
+    # to be part of the timings
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    run_to_completion(call)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    result = {
+        "name": name,
+        "iterations": iterations,
+        "p50_ms": percentile(timings, 0.50) * 1000,
+        "p95_ms": percentile(timings, 0.95) * 1000,
+        "p99_ms": percentile(timings, 0.99) * 1000,
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "queries_per_call": sum(queries) / len(queries),
+        "peak_memory_kib": peak / 1024,
+        "errors": errors,
+    }
+    print("{name:<40} p50 {p50_ms:>8.1f}ms  p95 {p95_ms:>8.1f}ms  p99 {p99_ms:>8.1f}ms  "
+          "{queries_per_call:>6.1f} queries  {peak_memory_kib:>8.0f} KiB  {errors} errors".format(**result))
+    return result
+
+def cases(fake_bot, users, rng):
+    def handler(function, text):
+        def call():
+            function(fake_bot, fake_update(rng.randint(1, users), text))
+        return call
+
+    def clear_chart_cache():
+        bot.CHART_CACHE = bot.LRUCache(bot.CHART_CACHE_SIZE, 24 * 60 * 60)
+
+    def reset_summaries():
+        with bot.transaction() as cursor:
+            cursor.execute("DELETE FROM emailoutbox")
+            cursor.execute("UPDATE summary SET last_emailed = 'epoch'")
+
+    yesterday = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%d-%m-%Y")
+    yield "/meditate", handler(bot.meditate, "/meditate 20"), None
+    yield "/meditate backdated", handler(bot.meditate, "/meditate 20 " + yesterday), None
+    yield "/sleep", handler(bot.sleep, "/sleep 7.5"), None
+    yield "/anxiety", handler(bot.anxiety, "/anxiety 4"), None
+    yield "/happiness", handler(bot.happiness, "/happiness 7"), None
+    yield "/journal", handler(bot.journaladd, "/journal Sat for twenty minutes by the window"), None
+    yield "/exercise", handler(bot.exercise, "/exercise run 5km"), None
+    yield "/journalentries", handler(bot.journallookup, "/journalentries " + yesterday), None
+    yield "/streak", handler(bot.streak, "/streak"), None
+    yield "/top", handler(bot.top, "/top 10"), bot.invalidate_leaderboard
+    yield "/top cached", handler(bot.top, "/top 10"), None
+    yield "/reminders", handler(bot.schedulereminders, "/reminders 7AM 9PM Europe/Amsterdam"), None
+    for command in bot.STATS_CHARTS:
+        for period in bot.PERIOD_DAYS:
+            yield "{} {}".format(command, period), handler(bot.stats, "{} {}".format(command, period)), clear_chart_cache
+    yield "get_streak_of", lambda: bot.get_streak_of(rng.randint(1, users)), None
+    yield "job executereminders", lambda: bot.executereminders(fake_bot, None), None
+    yield "job send_summaries", lambda: bot.send_summaries(fake_bot, None), reset_summaries
+    yield "job update_leaderboard", lambda: bot.update_leaderboard(fake_bot, None), None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's handlers and jobs on synthetic data")
+    parser.add_argument("--db-name", default=bot.DB_NAME + "_benchmark")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--days", type=int, default=365, help="days of history per user")
+    parser.add_argument("--subscribers", type=int, default=None, help="users with weekly summaries, default all")
+    parser.add_argument("--reminder-users", type=int, default=None, help="users with reminders, default half")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--only", default=None, help="only run cases whose name contains this")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the data from a previous run")
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args()
+
+    create_database(args.db_name)
+    bot.DB_NAME = args.db_name
+    bot.PreparingConnection.cursor = counting_cursor
+    # Rate limits would only measure how long the outbox waits
+    bot.OUTBOX = bot.Outbox(bot.OUTBOX_WORKERS, 1e9, 1e9, 1e9, bot.OUTBOX_MAX_ATTEMPTS)
+    bot.init_database()
+
+    subscribers = args.users if args.subscribers is None else args.subscribers
+    reminder_users = args.users // 2 if args.reminder_users is None else args.reminder_users
+    seed_seconds = None
+    if not args.no_seed:
+        print("Seeding {} users with {} days of history...".format(args.users, args.days))
+        seed_seconds = seed(args.users, args.days, subscribers, reminder_users)
+        print("Seeded in {:.1f}s".format(seed_seconds))
+
+    with bot.transaction() as cursor:
+        cursor.execute("SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM summary), "
+                       "(SELECT COUNT(DISTINCT id) FROM meditationreminders), "
+                       "(SELECT COUNT(*) FROM meditation), (SELECT current_date - MIN(created_at)::date + 1 FROM meditation), "
+                       "pg_database_size(current_database())")
+        user_count, subscriber_count, reminder_user_count, meditation_count, days, database_bytes = cursor.fetchone()
+
+    # Keep the one-off cost of the lazy imports out of the first case
+    bot.load_plotting()
+    bot.load_dateparser()
+
+    fake_bot = FakeBot()
+    rng = random.Random(1)
+    results = []
+    for name, call, setup in cases(fake_bot, user_count, rng):
+        if args.only and args.only not in name:
+            continue
+        results.append(measure(name, call, args.iterations, setup))
+
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    report = {
+        "started_at": datetime.datetime.now().isoformat(),
+        "revision": revision,
+        "data": {
+            "users": user_count,
+            "days": days,
+            "subscribers": subscriber_count,
+            "reminder_users": reminder_user_count,
+            "meditation_rows": meditation_count,
+            "database_bytes": database_bytes,
+            "seed_seconds": seed_seconds,
+        },
+        "settings": {
+            "iterations": args.iterations,
+            "bot_workers": bot.BOT_WORKERS,
+            "render_workers": bot.RENDER_WORKERS,
+            "write_buffer": bot.WRITE_BUFFER_ENABLED,
+        },
+        "results": results,
+        "telegram_calls": fake_bot.calls,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print("Wrote {}".format(args.output))
+
+    bot.WRITE_BUFFER.stop()
+
+if __name__ == "__main__":
+    main()
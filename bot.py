@@ -1,111 +1,1508 @@
 #!/usr/bin/python
 
-from collections import defaultdict
+import time
+STARTUP_STARTED = time.perf_counter()
+
+from collections import defaultdict, deque, namedtuple, OrderedDict
 from configparser import ConfigParser
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
 import datetime
 from email.mime.text import MIMEText
 from email.utils import parseaddr
-import os
+import functools
+import heapq
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import itertools
+import json
+import logging
+from logging.handlers import RotatingFileHandler
 import re
 import smtplib
+from socketserver import ThreadingMixIn
+import sys
+import tempfile
+import threading
+import zipfile
+from types import SimpleNamespace
+
+# (component, seconds) pairs for the startup timing report
+STARTUP_TIMINGS = [("import stdlib", time.perf_counter() - STARTUP_STARTED)]
+STARTUP_TIMINGS_LOCK = threading.Lock()
+
+def record_startup(component, started):
+    with STARTUP_TIMINGS_LOCK:
+        STARTUP_TIMINGS.append((component, time.perf_counter() - started))
+
+_started = time.perf_counter()
 from pytz import timezone, all_timezones
+record_startup("import pytz", _started)
 
-import dateparser
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+_started = time.perf_counter()
 import psycopg2
-from psycopg2 import sql
-import seaborn as sns
-sns.set(style="white")
+from psycopg2 import pool, sql
+from psycopg2.extras import execute_values
+record_startup("import psycopg2", _started)
+
+_started = time.perf_counter()
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from telegram.error import BadRequest
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, TelegramError, Unauthorized
+record_startup("import telegram", _started)
+
+LOGGER = logging.getLogger(__name__)
 
+_started = time.perf_counter()
 PARSER = ConfigParser()
 PARSER.read('creds.ini')
 
 TOKEN = PARSER.get('DEFAULT', 'BOT_TOKEN')
 
-UPDATER = Updater(token=TOKEN)
+BOT_WORKERS = PARSER.getint('DEFAULT', 'BOT_WORKERS', fallback=4)
+# Pointed at a stand-in such as the one in loadtest.py for testing
+BOT_API_URL = PARSER.get('DEFAULT', 'BOT_API_URL', fallback='https://api.telegram.org/bot')
+HANDLER_QUEUE_SIZE = PARSER.getint('DEFAULT', 'HANDLER_QUEUE_SIZE', fallback=100)
+
+# "polling" or "webhook". Without a certificate the webhook server speaks
+# plain HTTP and expects TLS to be terminated in front of it.
+MODE = PARSER.get('DEFAULT', 'MODE', fallback='polling')
+WEBHOOK_LISTEN = PARSER.get('DEFAULT', 'WEBHOOK_LISTEN', fallback='127.0.0.1')
+WEBHOOK_PORT = PARSER.getint('DEFAULT', 'WEBHOOK_PORT', fallback=8443)
+WEBHOOK_PATH = PARSER.get('DEFAULT', 'WEBHOOK_PATH', fallback=TOKEN)
+WEBHOOK_URL = PARSER.get('DEFAULT', 'WEBHOOK_URL', fallback=None)
+WEBHOOK_CERT = PARSER.get('DEFAULT', 'WEBHOOK_CERT', fallback=None)
+WEBHOOK_KEY = PARSER.get('DEFAULT', 'WEBHOOK_KEY', fallback=None)
+
+UPDATER = Updater(token=TOKEN, base_url=BOT_API_URL, workers=BOT_WORKERS)
 DISPATCHER = UPDATER.dispatcher
 JOBQUEUE = UPDATER.job_queue
+record_startup("load config and create Updater", _started)
 
-CONNECTION = None
+POOL = None
+POOL_LOCK = threading.Lock()
 DB_NAME = PARSER.get('DEFAULT', 'DB_NAME')
 DB_USER = PARSER.get('DEFAULT', 'DB_USER')
 DB_PASSWORD = PARSER.get('DEFAULT', 'DB_PASSWORD')
 DB_HOST = PARSER.get('DEFAULT', 'DB_HOST')
+DB_PORT = PARSER.get('DEFAULT', 'DB_PORT', fallback="5432")
+DB_POOL_MIN = PARSER.getint('DEFAULT', 'DB_POOL_MIN', fallback=1)
+DB_POOL_TIMEOUT = PARSER.getfloat('DEFAULT', 'DB_POOL_TIMEOUT', fallback=10.0)
+DB_CONNECT_TIMEOUT = PARSER.getint('DEFAULT', 'DB_CONNECT_TIMEOUT', fallback=5)
+DB_HEALTH_CHECK_INTERVAL = PARSER.getfloat('DEFAULT', 'DB_HEALTH_CHECK_INTERVAL', fallback=30.0)
 
 GMAIL_EMAIL = PARSER.get('DEFAULT', 'GMAIL_EMAIL')
 GMAIL_PASSWORD = PARSER.get('DEFAULT', 'GMAIL_PASSWORD')
+# Point these at a local server (with STARTTLS and LOGIN off) to test mail
+SMTP_HOST = PARSER.get('DEFAULT', 'SMTP_HOST', fallback='smtp.gmail.com')
+SMTP_PORT = PARSER.getint('DEFAULT', 'SMTP_PORT', fallback=587)
+SMTP_STARTTLS = PARSER.getboolean('DEFAULT', 'SMTP_STARTTLS', fallback=True)
+SMTP_LOGIN = PARSER.getboolean('DEFAULT', 'SMTP_LOGIN', fallback=True)
+MAIL_WORKERS = PARSER.getint('DEFAULT', 'MAIL_WORKERS', fallback=4)
+MAIL_BATCH_SIZE = PARSER.getint('DEFAULT', 'MAIL_BATCH_SIZE', fallback=50)
+MAIL_POLL_INTERVAL = PARSER.getfloat('DEFAULT', 'MAIL_POLL_INTERVAL', fallback=60.0)
+MAIL_MAX_ATTEMPTS = PARSER.getint('DEFAULT', 'MAIL_MAX_ATTEMPTS', fallback=6)
+
+# 0 turns the metrics endpoint off
+METRICS_PORT = PARSER.getint('DEFAULT', 'METRICS_PORT', fallback=0)
+METRICS_LISTEN = PARSER.get('DEFAULT', 'METRICS_LISTEN', fallback='127.0.0.1')
+
+# Statements slower than SLOW_QUERY_MS are logged; once one has been slow
+# SLOW_QUERY_EXPLAIN_AFTER times its plan is captured, at most once per
+# SLOW_QUERY_EXPLAIN_INTERVAL seconds. 0 turns the slow-query log off and an
+# empty SLOW_QUERY_LOG keeps the plans in the main log.
+SLOW_QUERY_MS = PARSER.getfloat('DEFAULT', 'SLOW_QUERY_MS', fallback=250.0)
+SLOW_QUERY_EXPLAIN_AFTER = PARSER.getint('DEFAULT', 'SLOW_QUERY_EXPLAIN_AFTER', fallback=3)
+SLOW_QUERY_EXPLAIN_INTERVAL = PARSER.getfloat('DEFAULT', 'SLOW_QUERY_EXPLAIN_INTERVAL', fallback=3600.0)
+SLOW_QUERY_LOG = PARSER.get('DEFAULT', 'SLOW_QUERY_LOG', fallback='slow_queries.log')
+SLOW_QUERY_LOG_BYTES = PARSER.getint('DEFAULT', 'SLOW_QUERY_LOG_BYTES', fallback=10 * 1024 * 1024)
+SLOW_QUERY_LOG_BACKUPS = PARSER.getint('DEFAULT', 'SLOW_QUERY_LOG_BACKUPS', fallback=5)
+
+WRITE_BUFFER_ENABLED = PARSER.getboolean('DEFAULT', 'WRITE_BUFFER_ENABLED', fallback=False)
+WRITE_BUFFER_MAX_ROWS = PARSER.getint('DEFAULT', 'WRITE_BUFFER_MAX_ROWS', fallback=200)
+WRITE_BUFFER_MAX_DELAY = PARSER.getfloat('DEFAULT', 'WRITE_BUFFER_MAX_DELAY', fallback=0.005)
+
+LEADERBOARD_SIZE = 20
+LEADERBOARD = {"rows": None, "day": None}
+LEADERBOARD_LOCK = threading.Lock()
+
+# Charts are drawn on their own threads using matplotlib's object-oriented API
+# rather than pyplot, whose global figure state isn't thread-safe
+RENDER_WORKERS = PARSER.getint('DEFAULT', 'RENDER_WORKERS', fallback=2)
+RENDER_POOL = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+# Exports run on their own small pool so a few large histories can't tie up
+# the handler workers or more than EXPORT_WORKERS database connections
+EXPORT_WORKERS = PARSER.getint('DEFAULT', 'EXPORT_WORKERS', fallback=1)
+EXPORT_BATCH_SIZE = PARSER.getint('DEFAULT', 'EXPORT_BATCH_SIZE', fallback=2000)
+EXPORT_POOL = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+EXPORTS_RUNNING = set()
+EXPORTS_LOCK = threading.Lock()
+
+# Every thread that may hold a connection at once: the handler workers, the
+# main and JobQueue threads, the mailer and its workers, the write buffer,
+# the exports and the slow-query EXPLAIN thread
+DB_POOL_MAX = PARSER.getint('DEFAULT', 'DB_POOL_MAX', fallback=BOT_WORKERS + 2 + MAIL_WORKERS + 1 + 1 + EXPORT_WORKERS + 1)
+
+# matplotlib, seaborn and dateparser take seconds to import between them, so
+# they're loaded on first use (or warmed up in the background) rather than
+# holding up the start of polling
+PLOTTING = None
+PLOTTING_LOCK = threading.Lock()
+DATEPARSER = None
+DATEPARSER_LOCK = threading.Lock()
+
+# Migrations run after polling has started; anything that needs the database
+# before they have finished waits for them, and fails if they failed
+SCHEMA_READY = threading.Event()
+SCHEMA_FAILED = threading.Event()
+
+# Telegram allows about 30 messages a second overall, one a second to any one
+# chat and 20 a minute to a group
+OUTBOX_GLOBAL_RATE = PARSER.getfloat('DEFAULT', 'OUTBOX_GLOBAL_RATE', fallback=30.0)
+OUTBOX_CHAT_RATE = PARSER.getfloat('DEFAULT', 'OUTBOX_CHAT_RATE', fallback=1.0)
+OUTBOX_GROUP_RATE = PARSER.getfloat('DEFAULT', 'OUTBOX_GROUP_RATE', fallback=20 / 60)
+OUTBOX_MAX_ATTEMPTS = PARSER.getint('DEFAULT', 'OUTBOX_MAX_ATTEMPTS', fallback=5)
+OUTBOX_WORKERS = PARSER.getint('DEFAULT', 'OUTBOX_WORKERS', fallback=4)
+# How long shutdown waits for queued messages to go out
+OUTBOX_DRAIN_TIMEOUT = PARSER.getfloat('DEFAULT', 'OUTBOX_DRAIN_TIMEOUT', fallback=30.0)
+
+USER_CACHE_SIZE = PARSER.getint('DEFAULT', 'USER_CACHE_SIZE', fallback=10000)
+USER_CACHE_TTL = PARSER.getfloat('DEFAULT', 'USER_CACHE_TTL', fallback=3600.0)
+CHART_CACHE_SIZE = PARSER.getint('DEFAULT', 'CHART_CACHE_SIZE', fallback=500)
+DATE_CACHE_SIZE = PARSER.getint('DEFAULT', 'DATE_CACHE_SIZE', fallback=1000)
+
+def load_plotting():
+    global PLOTTING
+
+    with PLOTTING_LOCK:
+        if PLOTTING is None:
+            started = time.perf_counter()
+            import matplotlib
+            matplotlib.use('Agg')
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            import matplotlib.dates as mdates
+            from matplotlib.figure import Figure
+            import seaborn as sns
+            sns.set(style="white")
+            PLOTTING = SimpleNamespace(FigureCanvasAgg=FigureCanvasAgg, mdates=mdates, Figure=Figure, sns=sns)
+            record_startup("import matplotlib + seaborn", started)
+
+    return PLOTTING
+
+def load_dateparser():
+    global DATEPARSER
+
+    with DATEPARSER_LOCK:
+        if DATEPARSER is None:
+            started = time.perf_counter()
+            import dateparser
+            DATEPARSER = dateparser
+            record_startup("import dateparser", started)
+
+    return DATEPARSER
+
+def warm_up():
+    load_plotting()
+    load_dateparser()
+    log_startup_report()
+
+def log_startup_report():
+    with STARTUP_TIMINGS_LOCK:
+        timings = list(STARTUP_TIMINGS)
+    LOGGER.info("Startup timings:\n%s", "\n".join(
+        "{:>8.1f}ms  {}".format(seconds * 1000, component) for component, seconds in timings
+    ))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Counters, histograms and gauges kept in memory and rendered in the
+# Prometheus text format. Gauges are read from a callback when scraped.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = OrderedDict()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+
+    def counter(self, name, help_text):
+        self._help[name] = ("counter", help_text)
+
+    def histogram(self, name, help_text):
+        self._help[name] = ("histogram", help_text)
+
+    def gauge(self, name, help_text, callback):
+        self._help[name] = ("gauge", help_text)
+        self._gauges[name] = callback
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += amount
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in self._help.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append("{}{} {}".format(name, format_labels(labels), value))
+            elif kind == "histogram":
+                for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                        lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", repr(bound)),)), bucket_count))
+                    lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", "+Inf"),)), count))
+                    lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+                    lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+            else:
+                try:
+                    lines.append("{} {}".format(name, self._gauges[name]()))
+                except Exception:
+                    LOGGER.exception("Reading gauge %s failed", name)
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+                          for key, value in labels) + "}"
+
+METRICS = Metrics()
+METRICS.histogram("zen_handler_seconds", "Time spent running a command handler, by command.")
+METRICS.histogram("zen_handler_queue_seconds", "Time an update waited for a handler worker, by command.")
+METRICS.counter("zen_handler_errors_total", "Command handlers that raised, by command.")
+METRICS.histogram("zen_job_seconds", "Time spent running a JobQueue job, by job.")
+METRICS.counter("zen_job_errors_total", "JobQueue jobs that raised, by job.")
+METRICS.counter("zen_db_queries_total", "Statements sent to Postgres, by the handler or job that sent them.")
+METRICS.histogram("zen_db_query_seconds", "Time spent in Postgres statements, by the handler or job that sent them.")
+METRICS.histogram("zen_telegram_request_seconds", "Time spent in Telegram API calls, by method.")
+METRICS.counter("zen_telegram_errors_total", "Telegram API calls that failed, by method and error.")
+METRICS.counter("zen_db_slow_queries_total", "Statements over SLOW_QUERY_MS, by the handler or job that sent them.")
+
+# What the current thread is working on, so database time can be put down to
+# the handler or job that caused it
+CONTEXT = threading.local()
+
+def current_context():
+    return getattr(CONTEXT, "name", None) or threading.current_thread().name.split("_")[0]
+
+# Times a block of work under `name`, counting it as an error if it raises
+@contextmanager
+def instrumented(metric, errors_metric, label, name):
+    previous = getattr(CONTEXT, "name", None)
+    CONTEXT.name = name
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        METRICS.inc(errors_metric, {label: name})
+        raise
+    finally:
+        METRICS.observe(metric, {label: name}, time.perf_counter() - started)
+        CONTEXT.name = previous
+
+# Wraps a JobQueue callback so its runs are timed
+def instrumented_job(callback):
+    @functools.wraps(callback)
+    def run(bot, job):
+        with instrumented("zen_job_seconds", "zen_job_errors_total", "job", callback.__name__):
+            callback(bot, job)
+    return run
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = METRICS.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
 
-def get_connection():
-    global CONNECTION
+# http.server only gained ThreadingHTTPServer in Python 3.7
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_metrics_server(listen, port):
+    server = MetricsServer((listen, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    LOGGER.info("Serving metrics on http://%s:%d/metrics", listen, port)
+    return server
+
+# Wraps psycopg2's ThreadedConnectionPool so that checkouts wait (up to
+# DB_POOL_TIMEOUT) instead of failing when every connection is in use, and so
+# that dead or idle connections are checked before being handed out.
+class ConnectionPool:
+    def __init__(self, minconn, maxconn, timeout, health_check_interval, **kwargs):
+        self._pool = pool.ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+        self._health_check_interval = health_check_interval
+        self._last_used = {}
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise pool.PoolError("Timed out waiting for a database connection")
+        try:
+            # A connection that fails its health check is dropped and
+            # replaced by a freshly opened one
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                self._discard(conn)
+                conn = self._pool.getconn()
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, broken=False):
+        try:
+            if broken or conn.closed != 0:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def in_use(self):
+        return len(self._pool._used)
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    def _is_healthy(self, conn):
+        if conn.closed != 0:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self._health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
 
-    if not CONNECTION or CONNECTION.closed != 0:
-        CONNECTION = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port="5432"
-        )
+# Counts and times every statement for the metrics, and hands the slow ones
+# to the slow-query log
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        context = current_context()
+        labels = {"context": context}
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - started
+            METRICS.inc("zen_db_queries_total", labels)
+            METRICS.observe("zen_db_query_seconds", labels, elapsed)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            SLOW_QUERIES.record(self, query, vars, elapsed, context)
+        return result
+
+# Server-side prepared statements only live as long as the session that
+# prepared them, so each connection remembers which ones it already has
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.cursor_factory = TimedCursor
+
+def get_pool():
+    global POOL
+
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = ConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                DB_POOL_TIMEOUT,
+                DB_HEALTH_CHECK_INTERVAL,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                host=DB_HOST,
+                port=DB_PORT,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                connection_factory=PreparingConnection
+            )
+
+    return POOL
+
+# Checks out a connection for the duration of the block and yields a cursor.
+# The block's work is committed on exit and rolled back if it raises; a
+# connection that failed at the network level is closed rather than reused.
+@contextmanager
+def transaction():
+    SCHEMA_READY.wait()
+    if SCHEMA_FAILED.is_set():
+        raise RuntimeError("Database migrations failed")
+    connection_pool = get_pool()
+    conn = connection_pool.getconn()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        connection_pool.putconn(conn, broken=broken)
+
+PREPARED_STATEMENTS = {}
+PREPARED_STATEMENTS_LOCK = threading.Lock()
+
+# Runs a query written with $1, $2, ... placeholders as a named prepared
+# statement, preparing it on this connection the first time it is seen so
+# Postgres only parses and plans it once per session
+def execute_prepared(cursor, query, params=()):
+    if isinstance(query, sql.Composable):
+        query = query.as_string(cursor)
+
+    with PREPARED_STATEMENTS_LOCK:
+        if query not in PREPARED_STATEMENTS:
+            PREPARED_STATEMENTS[query] = "stmt_{}".format(len(PREPARED_STATEMENTS) + 1)
+        name = PREPARED_STATEMENTS[query]
+
+    if name not in cursor.connection.prepared:
+        cursor.execute("PREPARE {} AS {}".format(name, query))
+        cursor.connection.prepared.add(name)
+
+    if params:
+        placeholders = ", ".join(["%s"] * len(params))
+        cursor.execute("EXECUTE {} ({})".format(name, placeholders), params)
+    else:
+        cursor.execute("EXECUTE {}".format(name))
+
+SLOW_QUERY_LOGGER = logging.getLogger(__name__ + ".slow_queries")
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "VALUES")
+WRITE_KEYWORD = re.compile(r"\b(?:INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+# Describes parameters by type and length only, since they can hold journal
+# entries and email addresses
+def describe_params(params):
+    def describe(value):
+        if isinstance(value, (str, bytes, list, tuple)):
+            return "{}[{}]".format(type(value).__name__, len(value))
+        return type(value).__name__
+
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join("{}: {}".format(key, describe(value)) for key, value in params.items()) + "}"
+    return "(" + ", ".join(describe(value) for value in params) + ")"
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+# Strips the literals out of a statement so that, say, multi-row inserts of
+# different rows count as the same statement. Statements from execute_values
+# have their values inlined, so this is also all of a statement that's logged.
+def fingerprint(statement):
+    statement = STRING_LITERAL.sub("?", statement)
+    statement = re.sub(r"(?<![$\w])\d+(?:\.\d+)?\b", "?", statement)
+    statement = re.sub(r"\?::\w+", "?", statement)
+    statement = re.sub(r"\(\?(?:, ?\?)*\)(?:\s*,\s*\(\?(?:, ?\?)*\))+", "(...)", statement)
+    return " ".join(statement.split())
+
+# Whether running the statement can't change anything, counting a WITH as a
+# write if any of its parts are. Errs on the side of calling SELECT ... FOR
+# UPDATE a write too.
+def is_read_only(statement):
+    statement = STRING_LITERAL.sub("''", statement)
+    return (statement.lstrip().split(" ")[0].upper() in ("SELECT", "WITH", "VALUES")
+            and not WRITE_KEYWORD.search(statement))
+
+# Logs statements that took longer than SLOW_QUERY_MS along with the shape of
+# their parameters and the handler or job that sent them. Statements that
+# keep turning up get explained in the background and the plan is written to
+# the slow-query log. Reads get EXPLAIN (ANALYZE, BUFFERS); writes only get a
+# plain EXPLAIN, since ANALYZE would run them again and hold their row locks
+# until the rollback.
+class SlowQueryLog:
+    def __init__(self, explain_after, explain_interval):
+        self._explain_after = explain_after
+        self._explain_interval = explain_interval
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._explained = {}
+        self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+
+    def record(self, cursor, query, params, elapsed, context):
+        if context == "explain":
+            return
+        if isinstance(query, sql.Composable):
+            query = query.as_string(cursor)
+        elif isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        statement = self._statement_text(query)
+        key = fingerprint(statement)
+
+        METRICS.inc("zen_db_slow_queries_total", {"context": context})
+        LOGGER.warning("Slow query (%.0f ms) in %s with params %s: %s",
+                       elapsed * 1000, context, describe_params(params), key[:500])
+        SLOW_QUERY_LOGGER.info("%.0f ms in %s with params %s:\n%s",
+                               elapsed * 1000, context, describe_params(params), key)
+
+        # Migrations hold locks the EXPLAIN would wait on
+        if not SCHEMA_READY.is_set() or statement.lstrip().split(" ")[0].upper() not in EXPLAINABLE:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._counts[key] += 1
+            count = self._counts[key]
+            if count < self._explain_after:
+                return
+            if now - self._explained.get(key, -self._explain_interval) < self._explain_interval:
+                return
+            self._explained[key] = now
+        self._explainer.submit(self._explain, key, statement, query, params, elapsed, count)
+
+    # Statements run through execute_prepared only show up as EXECUTE stmt_n
+    @staticmethod
+    def _statement_text(query):
+        match = re.match(r"\s*EXECUTE (stmt_\d+)", query)
+        if match:
+            with PREPARED_STATEMENTS_LOCK:
+                for text, name in PREPARED_STATEMENTS.items():
+                    if name == match.group(1):
+                        return text
+        return query
+
+    def _explain(self, key, statement, query, params, elapsed, count):
+        connection_pool = get_pool()
+        conn = connection_pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cursor:
+                # Don't let a runaway plan hold a connection for long
+                cursor.execute("SET LOCAL statement_timeout = %s", (int(max(elapsed * 10, 1) * 1000),))
+                match = re.match(r"\s*EXECUTE (stmt_\d+)", query)
+                if match and match.group(1) not in conn.prepared:
+                    cursor.execute("PREPARE {} AS {}".format(match.group(1), statement))
+                    conn.prepared.add(match.group(1))
+                analyze = is_read_only(statement)
+                cursor.execute(("EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN ") + query, params)
+                # Conditions in the plan quote the statement's strings
+                plan = STRING_LITERAL.sub("'?'", "\n".join(row[0] for row in cursor.fetchall()))
+            SLOW_QUERY_LOGGER.info("%s plan for statement slow %d times:\n%s\n%s",
+                                   "Actual" if analyze else "Estimated", count, key, plan)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            LOGGER.exception("Explaining slow query failed")
+        except Exception:
+            LOGGER.exception("Explaining slow query failed")
+        finally:
+            if not broken:
+                conn.rollback()
+            connection_pool.putconn(conn, broken=broken)
+
+SLOW_QUERIES = SlowQueryLog(SLOW_QUERY_EXPLAIN_AFTER, SLOW_QUERY_EXPLAIN_INTERVAL)
+
+# Sends the slow statements and their plans to their own rotating file
+def configure_slow_query_log():
+    if not SLOW_QUERY_LOG:
+        return
+    handler = RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=SLOW_QUERY_LOG_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    SLOW_QUERY_LOGGER.addHandler(handler)
+    SLOW_QUERY_LOGGER.setLevel(logging.INFO)
+    SLOW_QUERY_LOGGER.propagate = False
+
+User = namedtuple("User", ["id", "first_name", "last_name", "username", "haspm"])
+
+# Least-recently-used cache that holds at most `size` entries. Entries also
+# expire after `ttl` seconds so that, for instance, a change made directly in
+# the database is eventually picked up.
+class LRUCache:
+    def __init__(self, size, ttl):
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+USER_CACHE = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+CHART_CACHE = LRUCache(CHART_CACHE_SIZE, 24 * 60 * 60)
+DATE_CACHE = LRUCache(DATE_CACHE_SIZE, 24 * 60 * 60)
+
+# Counts the writes to each (table, user) and (table, everyone), so cached
+# charts can tell whether the data behind them has changed
+DATA_VERSIONS = defaultdict(int)
+DATA_VERSIONS_LOCK = threading.Lock()
+
+def bump_data_version(table, user_id):
+    with DATA_VERSIONS_LOCK:
+        DATA_VERSIONS[(table, user_id)] += 1
+        DATA_VERSIONS[(table, None)] += 1
+
+def get_data_version(table, user_id):
+    with DATA_VERSIONS_LOCK:
+        return DATA_VERSIONS[(table, user_id)]
+
+EVENT_TABLES = ("meditation", "anxiety", "sleep", "fasting", "happiness", "journal", "exercise", "done")
+
+Index = namedtuple("Index", ["name", "table", "columns", "method"])
+
+# Arbitrary key for the advisory lock that stops two instances starting up at
+# once from applying the same migration twice
+MIGRATION_LOCK_ID = 20180323
+
+def create_index_concurrently(cursor, index):
+    # A concurrent build that was interrupted leaves an invalid index behind,
+    # which IF NOT EXISTS would then happily skip over
+    cursor.execute(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "\
+        "WHERE pg_class.relname = %s AND NOT pg_index.indisvalid", (index.name,)
+    )
+    if cursor.fetchone() is not None:
+        cursor.execute(sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(index.name)))
+
+    cursor.execute(sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} USING {} ({})").format(
+        sql.Identifier(index.name),
+        sql.Identifier(index.table),
+        sql.SQL(index.method),
+        sql.SQL(", ").join(sql.Identifier(column) for column in index.columns)
+    ))
+
+def run_migration_step(cursor, step):
+    if isinstance(step, Index):
+        create_index_concurrently(cursor, step)
+    elif callable(step):
+        step(cursor)
+    else:
+        cursor.execute(step)
 
-    return CONNECTION
+# Brings the schema up to the latest version in MIGRATIONS, recording each
+# applied version in schemaversion so that a restart only costs one query
+def migrate():
+    conn = get_pool().getconn()
+    broken = False
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            try:
+                cursor.execute("CREATE TABLE IF NOT EXISTS schemaversion(\
+                    version INTEGER UNIQUE NOT NULL,\
+                    applied_at TIMESTAMP NOT NULL DEFAULT now()\
+                );")
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schemaversion")
+                current_version = cursor.fetchone()[0]
+
+                for version, steps in MIGRATIONS:
+                    if version <= current_version:
+                        continue
+                    concurrent = any(isinstance(step, Index) for step in steps)
+                    conn.autocommit = concurrent
+                    for step in steps:
+                        run_migration_step(cursor, step)
+                    cursor.execute("INSERT INTO schemaversion (version) VALUES (%s)", (version,))
+                    conn.commit()
+                    conn.autocommit = True
+            finally:
+                if not conn.autocommit:
+                    conn.rollback()
+                    conn.autocommit = True
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if not broken:
+            conn.autocommit = False
+        get_pool().putconn(conn, broken=broken)
+
+def init_database():
+    try:
+        migrate()
+    except BaseException:
+        # Let waiting jobs and handlers fail so the updater can stop
+        SCHEMA_FAILED.set()
+        raise
+    finally:
+        SCHEMA_READY.set()
+
+# Each user's runs of consecutive meditation days, with recent = 1 marking
+# the latest run
+STREAK_RUNS_CTE = \
+    "WITH days AS ("\
+        "SELECT DISTINCT id, created_at::date AS day FROM meditation {days_filter}"\
+    "), islands AS ("\
+        "SELECT id, day, day - (ROW_NUMBER() OVER (PARTITION BY id ORDER BY day))::integer AS grp FROM days"\
+    "), runs AS ("\
+        "SELECT id, COUNT(*) AS streak, MAX(day) AS last_day, "\
+        "ROW_NUMBER() OVER (PARTITION BY id ORDER BY grp DESC) AS recent "\
+        "FROM islands GROUP BY id, grp"\
+    ")"
+
+STREAK_RUNS_SQL = STREAK_RUNS_CTE + \
+    "INSERT INTO streaks (id, streak, last_day) "\
+    "SELECT users.id, COALESCE(runs.streak, 0), runs.last_day "\
+    "FROM users LEFT JOIN runs ON runs.id = users.id AND runs.recent = 1 {users_filter} "\
+    "ON CONFLICT (id) DO UPDATE SET streak = EXCLUDED.streak, last_day = EXCLUDED.last_day"
+
+# Recomputes the most recent run of consecutive meditation days from the raw
+# meditation rows. Only a single user's history is read unless user_id is None,
+# in which case every user without a stored streak is filled in.
+def rebuild_streaks(cursor, user_id=None):
+    if user_id is None:
+        query = STREAK_RUNS_SQL.format(
+            days_filter="WHERE id NOT IN (SELECT id FROM streaks)",
+            users_filter="WHERE users.id NOT IN (SELECT id FROM streaks)")
+        cursor.execute(query)
+    else:
+        query = STREAK_RUNS_SQL.format(days_filter="WHERE id = %s", users_filter="WHERE users.id = %s")
+        cursor.execute(query, (user_id, user_id))
+
+# Length of the run of meditation days ending the day before $2, walking back
+# one day at a time on the (id, created_at) index so only that run is read
+EARLIER_RUN_SQL = \
+    "WITH RECURSIVE run(day) AS ("\
+        "SELECT $2::date "\
+        "UNION ALL "\
+        "SELECT run.day - 1 FROM run WHERE EXISTS ("\
+            "SELECT 1 FROM meditation WHERE id = $1 AND created_at >= run.day - 1 AND created_at < run.day"\
+        ")"\
+    ")"\
+    "SELECT COUNT(*) - 1 FROM run"
+
+# Keeps the stored streak in step with a new meditation on `day`. Must run in
+# the same transaction as the insert so a rebuild sees the new row.
+def update_streak(cursor, user_id, day):
+    cursor.execute("SELECT streak, last_day FROM streaks WHERE id = %s FOR UPDATE", (user_id,))
+    state = cursor.fetchone()
+    if state is None:
+        rebuild_streaks(cursor, user_id)
+        return
+
+    streak_count, last_day = state
+    one_day = datetime.timedelta(days=1)
+    if last_day is None or day > last_day + one_day:
+        streak_count, last_day = 1, day
+    elif day == last_day + one_day:
+        streak_count, last_day = streak_count + 1, day
+    elif day == last_day - streak_count * one_day:
+        # Backdated into the gap right before the current run, which may now
+        # join up with an older run ending the day before
+        execute_prepared(cursor, EARLIER_RUN_SQL, (user_id, day))
+        streak_count += 1 + cursor.fetchone()[0]
+    else:
+        # Inside the current run or further back than it; nothing changes
+        return
+
+    cursor.execute("UPDATE streaks SET streak = %s, last_day = %s WHERE id = %s", (streak_count, last_day, user_id))
 
 def get_streak_of(user_id):
-    cursor = get_connection().cursor()
+    query = "SELECT CASE WHEN last_day >= current_date - 1 THEN streak ELSE 0 END FROM streaks WHERE id = $1"
+    with transaction() as cursor:
+        execute_prepared(cursor, query, (user_id,))
+        result = cursor.fetchone()
+        if result is None:
+            rebuild_streaks(cursor, user_id)
+            execute_prepared(cursor, query, (user_id,))
+            result = cursor.fetchone()
+    return result[0] if result else 0
+
+# Returns (user_id, stored, expected) for every user whose stored
+# (streak, last_day) disagrees with their latest run recounted from the raw
+# meditation rows, all in one query. Those users are rebuilt when repair is set.
+def check_streak_consistency(repair=False):
+    with transaction() as cursor:
+        cursor.execute(
+            STREAK_RUNS_CTE.format(days_filter="") +
+            "SELECT users.id, streaks.streak, streaks.last_day, COALESCE(runs.streak, 0), runs.last_day "\
+            "FROM users "\
+            "LEFT JOIN runs ON runs.id = users.id AND runs.recent = 1 "\
+            "JOIN streaks ON streaks.id = users.id "\
+            "WHERE streaks.streak <> COALESCE(runs.streak, 0) OR streaks.last_day IS DISTINCT FROM runs.last_day "\
+            "ORDER BY users.id"
+        )
+        mismatches = [(user_id, (streak, last_day), (expected, expected_last_day))
+                      for user_id, streak, last_day, expected, expected_last_day in cursor.fetchall()]
+
+        if repair and mismatches:
+            user_ids = [user_id for user_id, _, _ in mismatches]
+            cursor.execute(
+                STREAK_RUNS_SQL.format(days_filter="WHERE id = ANY(%s)", users_filter="WHERE users.id = ANY(%s)"),
+                (user_ids, user_ids)
+            )
+    return mismatches
+
+# Numeric tables that are also kept as one row per user, metric and day, so
+# charts and summaries read a row per day rather than every entry
+ROLLUP_TABLES = ("meditation", "sleep", "fasting", "happiness", "anxiety")
+
+ROLLUP_UPSERT_SQL = \
+    "INSERT INTO dailyrollups (id, metric, day, total, count, min, max, last_value, last_at) VALUES %s "\
+    "ON CONFLICT (id, metric, day) DO UPDATE SET "\
+    "total = dailyrollups.total + EXCLUDED.total, "\
+    "count = dailyrollups.count + EXCLUDED.count, "\
+    "min = LEAST(dailyrollups.min, EXCLUDED.min), "\
+    "max = GREATEST(dailyrollups.max, EXCLUDED.max), "\
+    "last_value = CASE WHEN EXCLUDED.last_at >= dailyrollups.last_at "\
+        "THEN EXCLUDED.last_value ELSE dailyrollups.last_value END, "\
+    "last_at = GREATEST(dailyrollups.last_at, EXCLUDED.last_at)"
+
+# Folds newly inserted rows into their days' rollups. Rows for the same day
+# are combined first, as one statement can't update a row twice.
+def update_rollups(cursor, rows):
+    days = {}
+    for row in rows:
+        if row.table not in ROLLUP_TABLES:
+            continue
+        key = (row.user_id, row.table, row.created_at.date())
+        value = float(row.value)
+        if key not in days:
+            days[key] = [value, 1, value, value, value, row.created_at]
+            continue
+        day = days[key]
+        day[0] += value
+        day[1] += 1
+        day[2] = min(day[2], value)
+        day[3] = max(day[3], value)
+        if row.created_at >= day[5]:
+            day[4], day[5] = value, row.created_at
+
+    if days:
+        # Always lock rollup rows in the same order so concurrent writers
+        # can't deadlock
+        execute_values(cursor, ROLLUP_UPSERT_SQL, [key + tuple(day) for key, day in sorted(days.items())])
+
+GROUP_ROLLUP_UPSERT_SQL = \
+    "INSERT INTO grouprollups (metric, day, total, count) VALUES %s "\
+    "ON CONFLICT (metric, day) DO UPDATE SET "\
+    "total = grouprollups.total + EXCLUDED.total, "\
+    "count = grouprollups.count + EXCLUDED.count"
+
+# The same for the whole group. Every write on a day touches that day's row,
+# so this is left until last to hold its lock as briefly as possible.
+def update_group_rollups(cursor, rows):
+    days = defaultdict(lambda: [0.0, 0])
+    for row in rows:
+        if row.table in ROLLUP_TABLES:
+            day = days[(row.table, row.created_at.date())]
+            day[0] += float(row.value)
+            day[1] += 1
+
+    if days:
+        execute_values(cursor, GROUP_ROLLUP_UPSERT_SQL, [key + tuple(day) for key, day in sorted(days.items())])
+
+# Rebuilds the rollups of every metric from the raw tables. Each table is
+# locked against writes while its rollups are replaced.
+def backfill_rollups(cursor):
+    for table in ROLLUP_TABLES:
+        cursor.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(sql.Identifier(table)))
+        cursor.execute("DELETE FROM dailyrollups WHERE metric = %s", (table,))
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO dailyrollups (id, metric, day, total, count, min, max, last_value, last_at) "\
+                "SELECT id, %s, created_at::date, SUM(value), COUNT(*), MIN(value), MAX(value), "\
+                "(array_agg(value ORDER BY created_at DESC, ctid DESC))[1], MAX(created_at) "\
+                "FROM {} GROUP BY id, created_at::date"
+            ).format(sql.Identifier(table)),
+            (table,)
+        )
+
+def backfill_group_rollups(cursor):
+    cursor.execute("DELETE FROM grouprollups")
     cursor.execute(
-        sql.SQL(
-            "WITH t AS ("\
-                "SELECT distinct(meditation.created_at::date) AS created_at "\
-                "FROM meditation "\
-                "WHERE id = %s"\
-            ")"\
-            "SELECT COUNT(*) FROM t WHERE t.created_at > ("\
-                "SELECT d.d "\
-                "FROM generate_series('2018-01-01'::date, TIMESTAMP 'yesterday'::date, '1 day') d(d) "\
-                "LEFT OUTER JOIN t ON t.created_at = d.d::date "\
-                "WHERE t.created_at IS NULL "\
-                "ORDER BY d.d DESC "\
-                "LIMIT 1"\
-            ")"
-        ), (user_id,)
+        "INSERT INTO grouprollups (metric, day, total, count) "\
+        "SELECT metric, day, SUM(total), SUM(count) FROM dailyrollups GROUP BY metric, day"
     )
-    results = cursor.fetchall()
-    get_connection().commit()
-    return results[0][0]
+
+# Returns (day, total, count) for each day with entries between start_date
+# and end_date, for user_id or for the whole group when user_id is None
+def get_daily_rollups(metric, start_date=None, end_date=None, user_id=None):
+    if user_id is None:
+        query = "SELECT day, total, count FROM grouprollups WHERE metric = $1"
+    else:
+        query = "SELECT day, total, count FROM dailyrollups WHERE metric = $1 AND id = $2"
+    params = [metric] if user_id is None else [metric, user_id]
+
+    for operator, argument in ((">=", start_date), ("<=", end_date)):
+        if argument is not None:
+            params.append(argument.date() if isinstance(argument, datetime.datetime) else argument)
+            query += " AND day {} ${}".format(operator, len(params))
+
+    with transaction() as cursor:
+        execute_prepared(cursor, query + " ORDER BY day", params)
+        return cursor.fetchall()
+
+Row = namedtuple("Row", ["table", "user_id", "value", "created_at"])
+
+# Inserts rows with one multi-row INSERT per table, then brings the daily
+# rollups, the streaks of any meditators and the group totals up to date in
+# the same transaction
+def write_rows(cursor, rows):
+    by_table = defaultdict(list)
+    for row in rows:
+        by_table[row.table].append((row.user_id, row.value, row.created_at))
+    for table, values in by_table.items():
+        execute_values(
+            cursor,
+            sql.SQL("INSERT INTO {} (id, value, created_at) VALUES %s").format(sql.Identifier(table)).as_string(cursor),
+            values,
+            page_size=WRITE_BUFFER_MAX_ROWS
+        )
+
+    update_rollups(cursor, rows)
+
+    for row in rows:
+        if row.table == "meditation":
+            update_streak(cursor, row.user_id, row.created_at.date())
+
+    update_group_rollups(cursor, rows)
+
+def rows_written(rows):
+    for row in rows:
+        bump_data_version(row.table, row.user_id)
+    if any(row.table == "meditation" for row in rows):
+        invalidate_leaderboard()
 
 def add_to_table(table, user_id, value, sentdate):
-    cursor = get_connection().cursor()
-    cursor.execute(sql.SQL("INSERT INTO {} (id, value, created_at) VALUES (%s, %s, %s)").format(sql.Identifier(table)), (user_id, value, sentdate))
-    get_connection().commit()
-    cursor.close()
+    row = Row(table, user_id, value, sentdate)
+    if WRITE_BUFFER_ENABLED:
+        # Returns once the row is committed, so the reply still means it's saved
+        WRITE_BUFFER.put(row).result()
+        return
+
+    with transaction() as cursor:
+        write_rows(cursor, [row])
+    rows_written([row])
+
+# Group commit for add_to_table. Rows from concurrent handlers are collected
+# for up to max_delay seconds or max_rows rows and written in one transaction,
+# so a burst of logging costs one commit instead of one each. If a batch
+# fails, its rows are retried one by one so only the bad row's caller sees
+# the error.
+class WriteBuffer:
+    def __init__(self, max_rows, max_delay):
+        self._max_rows = max_rows
+        self._max_delay = max_delay
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._thread = None
+
+    # Returns a Future that resolves once the row has been committed
+    def put(self, row):
+        future = Future()
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError("Write buffer is stopped")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write_buffer", daemon=True)
+                self._thread.start()
+            self._pending.append((row, future))
+            self._wakeup.notify()
+        return future
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    # Writes out everything still buffered, then stops the flushing thread
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(lambda: self._pending or self._stopping)
+                if not self._pending:
+                    return
+                # Give other handlers a moment to join this batch
+                deadline = time.monotonic() + self._max_delay
+                while len(self._pending) < self._max_rows and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), self._max_rows))]
+            self._flush(batch)
+
+    def _flush(self, batch):
+        rows = [row for row, _ in batch]
+        try:
+            with transaction() as cursor:
+                write_rows(cursor, rows)
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+                return
+            LOGGER.exception("Writing a batch of %d rows failed, retrying them one by one", len(batch))
+            for item in batch:
+                self._flush([item])
+            return
+
+        rows_written(rows)
+        for _, future in batch:
+            future.set_result(None)
+
+WRITE_BUFFER = WriteBuffer(WRITE_BUFFER_MAX_ROWS, WRITE_BUFFER_MAX_DELAY)
+
+def refresh_leaderboard():
+    with transaction() as cursor:
+        cursor.execute(
+            "SELECT users.first_name, users.last_name, users.username, "\
+            "CASE WHEN streaks.last_day >= current_date - 1 THEN streaks.streak ELSE 0 END AS current_streak "\
+            "FROM users LEFT JOIN streaks ON streaks.id = users.id "\
+            "ORDER BY current_streak DESC, users.id "\
+            "LIMIT %s", (LEADERBOARD_SIZE,)
+        )
+        rows = cursor.fetchall()
+
+    with LEADERBOARD_LOCK:
+        LEADERBOARD["rows"] = rows
+        LEADERBOARD["day"] = datetime.date.today()
+    return rows
+
+def invalidate_leaderboard():
+    with LEADERBOARD_LOCK:
+        LEADERBOARD["rows"] = None
+
+# Streaks lapse at midnight without any write, so a cached board from an
+# earlier day is treated as stale too
+def get_leaderboard(count):
+    with LEADERBOARD_LOCK:
+        rows = LEADERBOARD["rows"]
+        if LEADERBOARD["day"] != datetime.date.today():
+            rows = None
+    if rows is None:
+        rows = refresh_leaderboard()
+    return rows[:count]
 
 def add_meditation_reminder(user_id, value, midnight):
-    cursor = get_connection().cursor()
-    cursor.execute("INSERT INTO meditationreminders (id, value, midnight) VALUES (%s, %s, %s)", (user_id, value, midnight))
-    get_connection().commit()
-    cursor.close()
-
-def get_values(table, start_date=None, end_date=None, user_id=None, value=None):
-    cursor = get_connection().cursor()
-    query = sql.SQL("SELECT * FROM {} WHERE "\
-                    "(%s is NULL OR id = %s) "\
-                    "AND (%s is NULL OR created_at > %s) "\
-                    "AND (%s is NULL OR created_at < %s) "\
-                    "AND (%s is NULL OR value = %s);").format(sql.Identifier(table))
-    cursor.execute(query, (user_id, user_id, start_date, start_date, end_date, end_date, value, value))
-    results = cursor.fetchall()
-    get_connection().commit()
+    with transaction() as cursor:
+        cursor.execute("INSERT INTO meditationreminders (id, value, midnight) VALUES (%s, %s, %s)", (user_id, value, midnight))
+
+# Only the filters that are actually given end up in the WHERE clause, so each
+# combination of table, columns and filters gets its own plan that can use the
+# (id, created_at) indexes
+def get_values(table, columns, start_date=None, end_date=None, user_id=None, value=None):
+    filters = []
+    params = []
+    for column, operator, argument in (("id", "=", user_id),
+                                       ("created_at", ">", start_date),
+                                       ("created_at", "<", end_date),
+                                       ("value", "=", value)):
+        if argument is not None:
+            params.append(argument)
+            filters.append(sql.SQL("{} {} ${}").format(sql.Identifier(column), sql.SQL(operator), sql.SQL(str(len(params)))))
+
+    query = sql.SQL("SELECT {} FROM {}").format(
+        sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+        sql.Identifier(table)
+    )
+    if filters:
+        query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(filters)
+
+    with transaction() as cursor:
+        execute_prepared(cursor, query, params)
+        results = cursor.fetchall()
     return results
 
+# Lanes of the outbox; lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available, 0 if one is available right now
+    def delay(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+# Central queue for everything the bot sends to Telegram, so handlers never
+# wait on the Telegram API themselves. Worker threads send items in priority
+# order while keeping to global and per-chat rate limits. Only one item per
+# chat is in flight at a time, which keeps a chat's messages in the order they
+# were queued. It retries after flood-control errors and network failures,
+# and keeps counters that describe how it's doing.
+class Outbox:
+    def __init__(self, workers, global_rate, chat_rate, group_rate, max_attempts):
+        self._workers = workers
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        # (priority, seq, item) for items that can go now and
+        # (ready_at, priority, seq, item) for ones waiting on a limit or retry
+        self._ready = []
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        # Chats with an item being sent or waiting to be retried (mapped to that
+        # item's sequence number), and items for them held back meanwhile
+        self._busy_chats = {}
+        self._blocked = defaultdict(list)
+        self._condition = threading.Condition()
+        self._threads = []
+        self._sent_times = []
+        self.counters = defaultdict(int)
+
+    # rate_limited=False lets an item skip the token buckets and ordered=False
+    # lets it go out of turn without holding up its chat (both used for
+    # deletions), and errors of the types in ignore are dropped silently.
+    # Returns a Future for the call's result, or the error it was given up on.
+    def put(self, bot, method, kwargs, priority=INTERACTIVE, callback=None, rate_limited=True, ignore=(), ordered=True):
+        item = {
+            "bot": bot, "method": method, "kwargs": kwargs, "callback": callback,
+            "rate_limited": rate_limited, "ignore": ignore, "ordered": ordered, "attempts": 0, "future": Future()
+        }
+        with self._condition:
+            self._start()
+            heapq.heappush(self._ready, (priority, next(self._sequence), item))
+            self.counters["enqueued"] += 1
+            self._condition.notify()
+        return item["future"]
+
+    def depth(self):
+        with self._condition:
+            return self._depth()
+
+    def _depth(self):
+        return len(self._ready) + len(self._delayed) + sum(len(items) for items in self._blocked.values()) + self._in_flight
+
+    def stats(self):
+        now = time.monotonic()
+        with self._condition:
+            recent = [sent_at for sent_at in self._sent_times if now - sent_at < 60]
+            self._sent_times = recent
+            stats = dict(self.counters)
+            stats["depth"] = self._depth()
+            stats["sent_per_second"] = len(recent) / 60
+        return stats
+
+    # Blocks until everything queued so far has been dealt with
+    def wait_until_empty(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._depth():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _start(self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._run, name="outbox_{}".format(len(self._threads)), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _bucket_for(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_full(now)}
+            if isinstance(chat_id, int) and chat_id < 0:
+                # Group chats have negative ids, and may use up their whole
+                # per-minute allowance in one go
+                bucket = TokenBucket(self._group_rate, max(1, self._group_rate * 60))
+            else:
+                bucket = TokenBucket(self._chat_rate, max(1, self._chat_rate))
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_item(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, priority, sequence, item = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (priority, sequence, item))
+
+                if not self._ready:
+                    self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+                    continue
+
+                priority, sequence, item = heapq.heappop(self._ready)
+                chat_id = item["kwargs"].get("chat_id")
+                if item["ordered"] and self._busy_chats.get(chat_id, sequence) != sequence:
+                    heapq.heappush(self._blocked[chat_id], (priority, sequence, item))
+                    continue
+
+                if item["rate_limited"]:
+                    chat_bucket = self._bucket_for(chat_id, now)
+                    wait = max(self._global_bucket.delay(now), chat_bucket.delay(now))
+                    if wait > 0:
+                        heapq.heappush(self._delayed, (now + wait, priority, sequence, item))
+                        continue
+                    self._global_bucket.take(now)
+                    chat_bucket.take(now)
+
+                if item["ordered"]:
+                    self._busy_chats[chat_id] = sequence
+                self._in_flight += 1
+                return priority, sequence, item
+
+    def _retry(self, priority, sequence, item, delay):
+        with self._condition:
+            self.counters["retried"] += 1
+            heapq.heappush(self._delayed, (time.monotonic() + delay, priority, sequence, item))
+
+    def _run(self):
+        while True:
+            priority, sequence, item = self._next_item()
+            retrying = False
+            try:
+                retrying = self._send(priority, sequence, item)
+            except Exception as error:
+                LOGGER.exception("Outbox failed sending %s", item["method"])
+                self._fail(item, error)
+            finally:
+                with self._condition:
+                    # A chat stays busy until its item is sent or given up on,
+                    # so nothing overtakes an item that is being retried
+                    if item["ordered"] and not retrying:
+                        chat_id = item["kwargs"].get("chat_id")
+                        self._busy_chats.pop(chat_id, None)
+                        for blocked in self._blocked.pop(chat_id, []):
+                            heapq.heappush(self._ready, blocked)
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    # Returns True if the item was put back to be retried
+    def _send(self, priority, sequence, item):
+        item["attempts"] += 1
+        for value in item["kwargs"].values():
+            # A file being re-sent after a failed attempt needs rewinding
+            if hasattr(value, "seek"):
+                value.seek(0)
+
+        try:
+            result = self._call(item)
+        except (BadRequest, Unauthorized, ChatMigrated) as error:
+            # Bad requests, blocked bots and the like won't get any better.
+            # BadRequest is a NetworkError, so this has to come first.
+            self._give_up(item, error)
+            return
+        except RetryAfter as error:
+            self._retry(priority, sequence, item, error.retry_after)
+            return True
+        except NetworkError as error:
+            if item["attempts"] < self._max_attempts:
+                self._retry(priority, sequence, item, min(2 ** item["attempts"], 60))
+                return True
+            self._fail(item, error)
+            return
+        except TelegramError as error:
+            self._give_up(item, error)
+            return
+
+        with self._condition:
+            self.counters["sent"] += 1
+            self._sent_times.append(time.monotonic())
+        if item["callback"] is not None:
+            try:
+                item["callback"](result)
+            except Exception:
+                LOGGER.exception("Outbox callback for %s failed", item["method"])
+        item["future"].set_result(result)
+
+    def _call(self, item):
+        labels = {"method": item["method"]}
+        started = time.perf_counter()
+        try:
+            return getattr(item["bot"], item["method"])(**item["kwargs"])
+        except TelegramError as error:
+            METRICS.inc("zen_telegram_errors_total", dict(labels, error=type(error).__name__))
+            raise
+        finally:
+            METRICS.observe("zen_telegram_request_seconds", labels, time.perf_counter() - started)
+
+    def _give_up(self, item, error):
+        if isinstance(error, item["ignore"]):
+            item["future"].set_result(None)
+        else:
+            self._fail(item, error)
+
+    def _fail(self, item, error):
+        with self._condition:
+            self.counters["failed"] += 1
+        LOGGER.warning("Giving up on %s to %s after %d attempts: %s", item["method"], item["kwargs"].get("chat_id"), item["attempts"], error)
+        item["future"].set_exception(error)
+
+OUTBOX = Outbox(OUTBOX_WORKERS, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_GROUP_RATE, OUTBOX_MAX_ATTEMPTS)
+
+def send_message(bot, priority=INTERACTIVE, callback=None, **kwargs):
+    return OUTBOX.put(bot, "send_message", kwargs, priority, callback)
+
+def send_photo(bot, priority=INTERACTIVE, callback=None, **kwargs):
+    return OUTBOX.put(bot, "send_photo", kwargs, priority, callback)
+
+def send_document(bot, priority=INTERACTIVE, callback=None, **kwargs):
+    return OUTBOX.put(bot, "send_document", kwargs, priority, callback)
+
+# Deleting the command is cosmetic, so it doesn't count against the rate
+# limits, never holds up the chat's replies, and it doesn't matter if the
+# message is already gone or the bot may not delete it
 def delete_message(bot, chat_id, message_id):
-    try:
-        bot.deleteMessage(chat_id=chat_id, message_id=message_id)
-    except BadRequest:
-        pass
+    OUTBOX.put(bot, "delete_message", {"chat_id": chat_id, "message_id": message_id},
+               rate_limited=False, ignore=(BadRequest,), ordered=False)
+
+# Runs handlers on a pool of worker threads instead of one at a time on the
+# dispatcher thread. Work submitted under the same key runs in the order it
+# was submitted, one item at a time, so a user's commands never overtake each
+# other. Once max_pending items are waiting, submit blocks, which leaves the
+# backlog in the Updater's update queue.
+class OrderedExecutor:
+    def __init__(self, workers, max_pending):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="handler")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, key, function, *args):
+        self._slots.acquire()
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((function, args))
+                return
+            self._queues[key] = deque()
+        self._pool.submit(self._run, key, function, args)
+
+    def _run(self, key, function, args):
+        try:
+            function(*args)
+        except Exception:
+            LOGGER.exception("Handler %s failed", function.__name__)
+        finally:
+            self._slots.release()
+
+        with self._lock:
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                if not self._queues:
+                    self._idle.notify_all()
+                return
+            function, args = queue.popleft()
+        # Back of the pool's queue, so one busy user can't hog a worker
+        self._pool.submit(self._run, key, function, args)
+
+    def pending(self):
+        with self._lock:
+            return len(self._queues) + sum(len(queue) for queue in self._queues.values())
+
+    # Waits for everything already submitted, including queued items
+    def shutdown(self):
+        with self._lock:
+            self._idle.wait_for(lambda: not self._queues)
+        self._pool.shutdown(wait=True)
+
+HANDLERS = OrderedExecutor(BOT_WORKERS, HANDLER_QUEUE_SIZE)
+
+METRICS.gauge("zen_update_queue_depth", "Updates fetched but not yet dispatched.", lambda: DISPATCHER.update_queue.qsize())
+METRICS.gauge("zen_handler_queue_depth", "Updates waiting for or running in a handler worker.", HANDLERS.pending)
+METRICS.gauge("zen_outbox_depth", "Telegram calls waiting in the outbox.", lambda: OUTBOX.depth())
+METRICS.gauge("zen_job_queue_depth", "Jobs scheduled on the JobQueue.", lambda: JOBQUEUE._queue.qsize())
+METRICS.gauge("zen_render_queue_depth", "Charts waiting for a render worker.", lambda: RENDER_POOL._work_queue.qsize())
+METRICS.gauge("zen_write_buffer_depth", "Logged entries waiting to be committed.", WRITE_BUFFER.pending)
+METRICS.gauge("zen_db_connections_in_use", "Database connections checked out of the pool.", lambda: POOL.in_use() if POOL is not None else 0)
+
+# Wraps a handler so the dispatcher hands it to HANDLERS, in order per user,
+# with its queueing and running time recorded under the command it was
+# registered for (never the message text, which anyone can make up)
+def in_order(callback, command=None):
+    name = "/" + command if command else callback.__name__
+
+    @functools.wraps(callback)
+    def submit(bot, update):
+        queued = time.perf_counter()
+
+        @functools.wraps(callback)
+        def run():
+            METRICS.observe("zen_handler_queue_seconds", {"command": name}, time.perf_counter() - queued)
+            with instrumented("zen_handler_seconds", "zen_handler_errors_total", "command", name):
+                callback(bot, update)
+
+        HANDLERS.submit(update.message.from_user.id, run)
+    return submit
 
 def help_message(bot, update):
     message = \
@@ -127,12 +1524,15 @@ def help_message(bot, update):
         "/groupstats \[period] = Total meditation time by the group\n"\
         "/happystats \[period] = Graph of your happiness levels\n"\
         "/journalentries \[dd-mm-yyyy] = Retrieve journal entries from date\n"\
+        "/journalsearch \[terms] \[period] = Search your journal entries, best matches first\n"\
         "/meditatestats \[period] = Graph of your meditation history\n"\
-        "/sleepstats \[period] = Graph of your sleep history"
+        "/sleepstats \[period] = Graph of your sleep history\n"\
+        "\n"\
+        "/export \[csv or json] = Sends you all of your data as a zip file"
 
     delete_message(bot, update.message.chat.id, update.message.message_id)
 
-    bot.send_message(chat_id=update.message.chat_id, parse_mode="Markdown", text=message)
+    send_message(bot, chat_id=update.message.chat_id, parse_mode="Markdown", text=message)
 
 def get_streak_emoji(streak_count):
     if streak_count == 0:
@@ -143,16 +1543,14 @@ def get_streak_emoji(streak_count):
 
 def private_message(bot, update):
     user = get_or_create_user(bot, update)
-    has_pm_bot = user[5]
-    if has_pm_bot is True:
-        bot.send_message(chat_id=update.message.from_user.id, text="Sorry, I didn't understand that!")
+    if user.haspm is True:
+        send_message(bot, chat_id=update.message.from_user.id, text="Sorry, I didn't understand that!")
     else:
-        cursor = get_connection().cursor()
-        cursor.execute('UPDATE users SET haspm = TRUE WHERE id = %s', (update.message.from_user.id,))
-        get_connection().commit()
-        cursor.close()
+        with transaction() as cursor:
+            cursor.execute('UPDATE users SET haspm = TRUE WHERE id = %s', (update.message.from_user.id,))
+        USER_CACHE.invalidate(update.message.from_user.id)
 
-        bot.send_message(chat_id=update.message.from_user.id, text="Thanks for PMing me! 👋 Now I can PM you too! " \
+        send_message(bot, chat_id=update.message.from_user.id, text="Thanks for PMing me! 👋 Now I can PM you too! " \
             "📨 Please don't delete this chat or I won't be able PM you anymore. 😢 " \
             "Any command that you can perform with me in the Mindful Makers channel can also be ran here! " \
             "That way you can keep things private with me! 💖")
@@ -161,14 +1559,14 @@ def meditate(bot, update):
     def validation_callback(parts):
         value = int(parts[0])
         if value < 5 or value > 1440:
-            bot.send_message(chat_id=update.message.from_user.id, text="🙏 Meditation time must be between 5 and 1440 minutes. 🙏")
+            send_message(bot, chat_id=update.message.from_user.id, text="🙏 Meditation time must be between 5 and 1440 minutes. 🙏")
             return False
         return value
 
     def success_callback(name_to_show, value, update, historic_date):
         streak_count = get_streak_of(update.message.from_user.id)
         emoji = get_streak_emoji(streak_count)
-        bot.send_message(chat_id=update.message.chat.id, text="✅ {} meditated for {} minutes{} ({}{}) 🙏".format(name_to_show, value, historic_date, streak_count, emoji))
+        send_message(bot, chat_id=update.message.chat.id, text="✅ {} meditated for {} minutes{} ({}{}) 🙏".format(name_to_show, value, historic_date, streak_count, emoji))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
         "table_name": "meditation",
@@ -180,12 +1578,9 @@ def schedulereminders(bot, update):
     parts = update.message.text.split(' ')
     if len(parts) == 2 and parts[1] == "off":
         # Delete is too powerful to have as a generalised function
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM meditationreminders WHERE id = %s', (update.message.from_user.id,))
-        conn.commit()
-        cursor.close()
-        bot.send_message(chat_id=update.message.from_user.id, text="Okay, you won't receive reminders anymore! ✌️")
+        with transaction() as cursor:
+            cursor.execute('DELETE FROM meditationreminders WHERE id = %s', (update.message.from_user.id,))
+        send_message(bot, chat_id=update.message.from_user.id, text="Okay, you won't receive reminders anymore! ✌️")
         return
 
     new_parts = []
@@ -194,7 +1589,7 @@ def schedulereminders(bot, update):
         for i in range(1, len(parts) - 1):
             part = parts[i]
             if not re.match('((([1-9])|(1[0-2]))(AM|PM|am|pm))', part):
-                bot.send_message(chat_id=update.message.from_user.id, text="Sorry, I didn't understand this hour: `{}`. "\
+                send_message(bot, chat_id=update.message.from_user.id, text="Sorry, I didn't understand this hour: `{}`. "\
                                 "It should look similar to this: `11AM`. The whole command should look similar to this: "\
                                 "`\\reminders 1PM 5PM 11PM UTC`. You can specify as many hours as you like.".format(part))
                 return
@@ -208,7 +1603,7 @@ def schedulereminders(bot, update):
             midnight = timez.localize(datetime.datetime(2018, 3, 23, 0, 0, 0)).astimezone(timezone("UTC")).hour
             new_parts.append((notification_hour, midnight))
     else:
-        bot.send_message(chat_id=update.message.from_user.id, text="Sorry, I didn't understand the timezone you specified: `{}`. "\
+        send_message(bot, chat_id=update.message.from_user.id, text="Sorry, I didn't understand the timezone you specified: `{}`. "\
                         "It can take the form of a specific time like `UTC` or as for a country `Europe/Amsterdam`. "\
                         "The whole command should look similar to this: "\
                         "`\\reminders 1PM 5PM 11PM UTC`. You can specify as many hours as you like.".format(parts[len(parts) - 1]))
@@ -218,41 +1613,50 @@ def schedulereminders(bot, update):
     for hours in new_parts:
         add_meditation_reminder(update.message.from_user.id, hours[0], hours[1])
     username = get_name(update.message.from_user)
-    has_pm_bot = user[5]
-    if has_pm_bot is True:
-        bot.send_message(chat_id=update.message.from_user.id, text="Okay {}, I've scheduled those reminders for you! 🕑".format(username))
+    if user.haspm is True:
+        send_message(bot, chat_id=update.message.from_user.id, text="Okay {}, I've scheduled those reminders for you! 🕑".format(username))
     else:
-        bot.send_message(chat_id=update.message.from_user.id, text="Okay {}, I've scheduled those reminders for you! 🕑 "\
+        send_message(bot, chat_id=update.message.from_user.id, text="Okay {}, I've scheduled those reminders for you! 🕑 "\
                         "If you haven't already, please send me a PM at @zenafbot so that I can PM your reminders to you!".format(username))
 
+def get_reminder_recipients(now):
+    # We don't want to notify if the user already meditated today
+    # Because of timezones, 'today' probably means something different for user
+    # So we check between their midnight and now. midnight will be an int like
+    # 2, meaning midnight is at 2AM UTC for the user.
+    with transaction() as cursor:
+        execute_prepared(
+            cursor,
+            "SELECT DISTINCT reminders.id FROM meditationreminders reminders "\
+            "WHERE reminders.value = $1 AND NOT EXISTS ("\
+                "SELECT 1 FROM meditation "\
+                "WHERE meditation.id = reminders.id "\
+                "AND meditation.created_at > date_trunc('day', $2::timestamp) + reminders.midnight * interval '1 hour' "\
+                    "- CASE WHEN reminders.midnight > $1 THEN interval '1 day' ELSE interval '0' END "\
+                "AND meditation.created_at < $2::timestamp"\
+            ")",
+            (now.hour, now)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
 def executereminders(bot, _):
+    started = time.perf_counter()
     now = datetime.datetime.now()
-    users_to_notify = get_values("meditationreminders", value=now.hour)
-    for user in users_to_notify:
-        user_id = user[0]
-        user_midnight_utc = user[2] # Will be an int like 2, meaning midnight is at 2AM UTC for the user
-        # We don't want to notify if the user already meditated today
-        # Because of timezones, 'today' probably means something different for user
-        # So we check between their midnight and now
-        if user_midnight_utc > now.hour:
-            start_check_period = get_x_days_before(now, 1).replace(hour=user_midnight_utc, minute=0, second=0)
-        else:
-            start_check_period = now.replace(hour=user_midnight_utc, minute=0, second=0)
-        meditations = get_values("meditation", start_date=start_check_period, end_date=now, user_id=user_id)
-        meditations_len = len(meditations)
-        if meditations_len == 0:
-            bot.send_message(chat_id=user_id, text="Hey! You asked me to send you a private message to remind you to meditate! 🙏 "\
-                                                   "You can turn off these notifications with `/reminders off`. 🕑")
+    users_to_notify = get_reminder_recipients(now)
+    for user_id in users_to_notify:
+        send_message(bot, BULK, chat_id=user_id, text="Hey! You asked me to send you a private message to remind you to meditate! 🙏 "\
+                                                      "You can turn off these notifications with `/reminders off`. 🕑")
+    LOGGER.info("Queued %d meditation reminders for %02d:00 in %.2fs, outbox: %s", len(users_to_notify), now.hour, time.perf_counter() - started, OUTBOX.stats())
 
 def find_rating_change(table, user_id, new_value):
     now = datetime.datetime.now()
     yesterday = get_x_days_before(now, 1)
     # We want to find change in rating between current value and most recent value in 24 last hours
-    ratings_last_day = get_values(table, start_date=yesterday, end_date=now, user_id=user_id)
+    ratings_last_day = get_values(table, ("value", "created_at"), start_date=yesterday, end_date=now, user_id=user_id)
     difference_str = ""
     if len(ratings_last_day) > 1:
-        ratings_last_day.sort(key=lambda r: r[2], reverse=True)
-        difference = new_value - ratings_last_day[1][1]
+        ratings_last_day.sort(key=lambda r: r[1], reverse=True)
+        difference = new_value - ratings_last_day[1][0]
         difference_str = ' ({})'.format("{:+}".format(difference) if difference else "no change")
     return difference_str
 
@@ -260,7 +1664,7 @@ def anxiety(bot, update):
     def validation_callback(parts):
         value = int(parts[0])
         if value < 0 or value > 10:
-            bot.send_message(chat_id=update.message.from_user.id, text="Please rate your anxiety between 0 (low) and 10 (high).")
+            send_message(bot, chat_id=update.message.from_user.id, text="Please rate your anxiety between 0 (low) and 10 (high).")
             return False
         return value
 
@@ -277,7 +1681,7 @@ def anxiety(bot, update):
             emoji = "😎"
 
         difference = find_rating_change("anxiety", update.message.from_user.id, value)
-        bot.send_message(chat_id=update.message.chat.id,
+        send_message(bot, chat_id=update.message.chat.id,
                          text="{} {} rated their anxiety at {}{}{} {}".format(emoji, name_to_show, value, difference, historic_date, emoji))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
@@ -290,7 +1694,7 @@ def happiness(bot, update):
     def validation_callback(parts):
         value = int(parts[0])
         if value < 0 or value > 10:
-            bot.send_message(chat_id=update.message.from_user.id, text="Please rate your happiness level 0-10")
+            send_message(bot, chat_id=update.message.from_user.id, text="Please rate your happiness level 0-10")
             return False
         return value
 
@@ -311,7 +1715,7 @@ def happiness(bot, update):
             emoji = "😭"
 
         difference = find_rating_change("happiness", update.message.from_user.id, value)
-        bot.send_message(chat_id=update.message.chat.id,
+        send_message(bot, chat_id=update.message.chat.id,
                          text="{} {} rated their happiness at {}{}{} {}".format(emoji, name_to_show, value, difference, historic_date, emoji))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
@@ -324,12 +1728,12 @@ def sleep(bot, update):
     def validation_callback(parts):
         value = float(parts[0])
         if value < 0 or value > 24:
-            bot.send_message(chat_id=update.message.from_user.id, text="💤 Please give how many hours you slept. 💤")
+            send_message(bot, chat_id=update.message.from_user.id, text="💤 Please give how many hours you slept. 💤")
             return False
         return value
 
     def success_callback(name_to_show, value, update, historic_date):
-        bot.send_message(chat_id=update.message.chat.id, text="✅ {} slept for {} hours{} 💤".format(name_to_show, value, historic_date))
+        send_message(bot, chat_id=update.message.chat.id, text="✅ {} slept for {} hours{} 💤".format(name_to_show, value, historic_date))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
         "table_name": "sleep",
@@ -341,12 +1745,12 @@ def fasting(bot, update):
     def validation_callback(parts):
         value = float(parts[0])
         if value < 0:
-            bot.send_message(chat_id=update.message.from_user.id, text="🍽 Please give how many hours you fasted for. 🍽")
+            send_message(bot, chat_id=update.message.from_user.id, text="🍽 Please give how many hours you fasted for. 🍽")
             return False
         return value
 
     def success_callback(name_to_show, value, update, historic_date):
-        bot.send_message(chat_id=update.message.chat.id, text="✅ {} fasted for {} hours{} 🍽".format(name_to_show, value, historic_date))
+        send_message(bot, chat_id=update.message.chat.id, text="✅ {} fasted for {} hours{} 🍽".format(name_to_show, value, historic_date))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
         "table_name": "fasting",
@@ -359,12 +1763,12 @@ def done(bot, update):
         activity = " ".join(parts)
         activity_len = len(activity)
         if activity_len == 0 or activity_len > 4000:
-            bot.send.message(chat_id=update.message.from_user.id, text="Please list your activity between 0 and 4000 characters!")
+            send_message(bot, chat_id=update.message.from_user.id, text="Please list your activity between 0 and 4000 characters!")
             return False
         return activity
 
     def success_callback(name_to_show, value, update, historic_date):
-        bot.send_message(chat_id=update.message.chat.id, text="✅ {} completed{}: {}".format(name_to_show, historic_date, value))
+        send_message(bot, chat_id=update.message.chat.id, text="✅ {} completed{}: {}".format(name_to_show, historic_date, value))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
         "table_name": "done",
@@ -377,12 +1781,12 @@ def exercise(bot, update):
         activity = " ".join(parts)
         activity_len = len(activity)
         if activity_len == 0 or activity_len > 4000:
-            bot.send_message(chat_id=update.message.from_user.id, text="💪 Please list your activity between 0 and 4000 characters! 💪")
+            send_message(bot, chat_id=update.message.from_user.id, text="💪 Please list your activity between 0 and 4000 characters! 💪")
             return False
         return activity
 
     def success_callback(name_to_show, value, update, historic_date):
-        bot.send_message(chat_id=update.message.chat.id, text="✅ {} exercised{}: {}".format(name_to_show, historic_date, value))
+        send_message(bot, chat_id=update.message.chat.id, text="✅ {} exercised{}: {}".format(name_to_show, historic_date, value))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
         "table_name": "exercise",
@@ -395,7 +1799,7 @@ def rest(bot, update):
     add_to_table("exercise", update.message.from_user.id, "rest", update.message.date)
     delete_message(bot, update.message.chat.id, update.message.message_id)
     name_to_show = get_name(update.message.from_user)
-    bot.send_message(chat_id=update.message.chat.id, text="✅ {} is resting today!".format(name_to_show,))
+    send_message(bot, chat_id=update.message.chat.id, text="✅ {} is resting today!".format(name_to_show,))
 
 def summary(bot, update):
     get_or_create_user(bot, update)
@@ -403,33 +1807,33 @@ def summary(bot, update):
     delete_message(bot, update.message.chat.id, update.message.message_id)
 
     if len(parts) != 2:
-        bot.send_message(chat_id=update.message.from_user.id, text="📧 Please give your email address or `off`!")
+        send_message(bot, chat_id=update.message.from_user.id, text="📧 Please give your email address or `off`!")
         return
 
     if parts[1] == "now":
-        send_summary_email(update.message.from_user.id)
-        bot.send_message(chat_id=update.message.from_user.id, text="📧 We've sent you a summary email!")
+        start_date, end_date = summary_window(datetime.datetime.now())
+        if queue_summary_emails(get_summary_stats(start_date, end_date, user_id=update.message.from_user.id), "manual"):
+            MAILER.wake()
+            send_message(bot, chat_id=update.message.from_user.id, text="📧 We're sending you a summary email!")
+        else:
+            send_message(bot, chat_id=update.message.from_user.id, text="📧 Please give your email address first!")
         return
 
     if parts[1] == "off":
-        cursor = get_connection().cursor()
-        cursor.execute('DELETE FROM summary WHERE id = %s', (update.message.from_user.id,))
-        get_connection().commit()
-        cursor.close()
-        bot.send_message(chat_id=update.message.from_user.id, text="📧 Okay, you'll no longer receive weekly summaries!")
+        with transaction() as cursor:
+            cursor.execute('DELETE FROM summary WHERE id = %s', (update.message.from_user.id,))
+        send_message(bot, chat_id=update.message.from_user.id, text="📧 Okay, you'll no longer receive weekly summaries!")
         return
 
     checked_addr = parseaddr(parts[1])[1]
 
     if "@" not in checked_addr:
-        bot.send_message(chat_id=update.message.from_user.id, text="📧 It doesn't seem like your email address ({}) is valid!".format(checked_addr,))
+        send_message(bot, chat_id=update.message.from_user.id, text="📧 It doesn't seem like your email address ({}) is valid!".format(checked_addr,))
         return
 
-    cursor = get_connection().cursor()
-    cursor.execute("INSERT INTO summary (id, email) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET email = %s", (update.message.from_user.id, checked_addr, checked_addr))
-    get_connection().commit()
-    cursor.close()
-    bot.send_message(chat_id=update.message.from_user.id, text="📧 Great! You'll start receiving summaries to {}".format(checked_addr,))
+    with transaction() as cursor:
+        cursor.execute("INSERT INTO summary (id, email) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET email = %s", (update.message.from_user.id, checked_addr, checked_addr))
+    send_message(bot, chat_id=update.message.from_user.id, text="📧 Great! You'll start receiving summaries to {}".format(checked_addr,))
 
 def journaladd(bot, update):
     def validation_callback(parts):
@@ -437,12 +1841,12 @@ def journaladd(bot, update):
         journalentry = " ".join(parts)
         journalentry_len = len(journalentry)
         if journalentry_len == 0 or journalentry_len > 4000:
-            bot.send_message(chat_id=update.message.from_user.id, text="✏️  Please give a journal entry between 0 and 4000 characters! ✏️")
+            send_message(bot, chat_id=update.message.from_user.id, text="✏️  Please give a journal entry between 0 and 4000 characters! ✏️")
             return False
         return journalentry
 
     def success_callback(name_to_show, _, update, historic_date):
-        bot.send_message(chat_id=update.message.chat.id, text="✅ {} logged a journal entry{}! ✏️".format(name_to_show, historic_date))
+        send_message(bot, chat_id=update.message.chat.id, text="✅ {} logged a journal entry{}! ✏️".format(name_to_show, historic_date))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
         "table_name": "journal",
@@ -454,27 +1858,189 @@ def journallookup(bot, update):
     user_id = update.message.from_user.id
     username = get_name(update.message.from_user)
     parts = update.message.text.split(' ')
-    datestring = " ".join(parts)
+    datestring = " ".join(parts[1:])
 
     # Parse the string - prefer DMY to MDY - most of world uses DMY
-    dateinfo = dateparser.parse(datestring, settings={'DATE_ORDER': 'DMY', 'STRICT_PARSING': True})
+    dateinfo = parse_date(datestring)
     if dateinfo is not None:
         dateinfo = dateinfo.date()
         start_of_day = datetime.datetime(dateinfo.year, dateinfo.month, dateinfo.day)
         end_of_day = start_of_day + datetime.timedelta(days=1)
-        entries = get_values("journal", start_date=start_of_day, end_date=end_of_day, user_id=user_id)
+        entries = get_values("journal", ("value", "created_at"), start_date=start_of_day, end_date=end_of_day, user_id=user_id)
         entries_len = len(entries)
 
         delete_message(bot, update.message.chat.id, update.message.message_id)
 
         if entries_len == 0:
-            bot.send_message(chat_id=update.message.chat.id, text="📓 {} had no journal entries on {}. 📓".format(username, dateinfo.isoformat()))
+            send_message(bot, chat_id=update.message.chat.id, text="📓 {} had no journal entries on {}. 📓".format(username, dateinfo.isoformat()))
 
         for entry in entries:
             # Separate entry for each message, or we'll hit the telegram length limit for many (or just a few long ones) in one day
-            bot.send_message(chat_id=update.message.chat.id, text="📓 Journal entry by {}, dated {}: {}".format(username, entry[2].strftime("%a. %d %B %Y %I:%M%p %Z"), entry[1]))
+            send_message(bot, chat_id=update.message.chat.id, text="📓 Journal entry by {}, dated {}: {}".format(username, entry[1].strftime("%a. %d %B %Y %I:%M%p %Z"), entry[0]))
     else:
-        bot.send_message(chat_id=update.message.from_user.id, text="Sorry, I couldn't understand that date format. 🤔")
+        send_message(bot, chat_id=update.message.from_user.id, text="Sorry, I couldn't understand that date format. 🤔")
+
+# Everything stored about a user, table by table
+EXPORT_TABLES = OrderedDict(
+    [(table, ("created_at", "value")) for table in EVENT_TABLES] + [
+        ("meditationreminders", ("created_at", "value", "midnight")),
+        ("summary", ("created_at", "email", "last_emailed")),
+    ]
+)
+
+# Bots can't upload documents larger than this
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+def export(bot, update):
+    get_or_create_user(bot, update)
+    parts = update.message.text.split(" ")
+    user_id = update.message.from_user.id
+    delete_message(bot, update.message.chat.id, update.message.message_id)
+
+    export_format = parts[1].lower() if len(parts) > 1 else "csv"
+    if export_format not in ("csv", "json"):
+        send_message(bot, chat_id=user_id, text="📦 Please choose `csv` or `json`!", parse_mode="Markdown")
+        return
+
+    with EXPORTS_LOCK:
+        if user_id in EXPORTS_RUNNING:
+            send_message(bot, chat_id=user_id, text="📦 Your export is already on its way!")
+            return
+        EXPORTS_RUNNING.add(user_id)
+
+    send_message(bot, chat_id=user_id, text="📦 Putting your data together, it'll be with you shortly!")
+    EXPORT_POOL.submit(run_export, bot, user_id, export_format)
+
+# The upload is waited for here, so EXPORT_WORKERS also caps how many outbox
+# workers (and archives read into memory for upload) exports take up at once;
+# keep it below OUTBOX_WORKERS
+def run_export(bot, user_id, export_format):
+    try:
+        with instrumented("zen_job_seconds", "zen_job_errors_total", "job", "export"):
+            archive = write_export(user_id, export_format)
+    except Exception:
+        LOGGER.exception("Exporting data for %s failed", user_id)
+        send_message(bot, chat_id=user_id, text="Sorry, something went wrong putting your data together. 😞")
+        with EXPORTS_LOCK:
+            EXPORTS_RUNNING.discard(user_id)
+        return
+
+    try:
+        if archive.seek(0, io.SEEK_END) > EXPORT_MAX_BYTES:
+            send_message(bot, chat_id=user_id, text="Sorry, your data is too large to send through Telegram. 😞")
+            return
+        archive.seek(0)
+        upload = send_document(bot, priority=BULK, chat_id=user_id, document=archive,
+                               filename="zen-export-{}.zip".format(datetime.date.today().isoformat()))
+        # The outbox has already logged why if it gave up
+        upload.exception()
+    finally:
+        archive.close()
+        with EXPORTS_LOCK:
+            EXPORTS_RUNNING.discard(user_id)
+
+# Streams each table through a named (server-side) cursor into a zip file on
+# disk, one member per table, so memory use stays flat however long the
+# history is. The tables are read in one read-only snapshot.
+def write_export(user_id, export_format):
+    archive = tempfile.TemporaryFile()
+    try:
+        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zipped, transaction() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            for table, columns in EXPORT_TABLES.items():
+                with cursor.connection.cursor(name="export_{}".format(table)) as rows, \
+                     zipped.open("{}.{}".format(table, export_format), "w") as member, \
+                     io.TextIOWrapper(member, encoding="utf-8", newline="") as text:
+                    rows.itersize = EXPORT_BATCH_SIZE
+                    rows.execute(
+                        sql.SQL("SELECT {} FROM {} WHERE id = %s ORDER BY created_at").format(
+                            sql.SQL(", ").join(map(sql.Identifier, columns)), sql.Identifier(table)
+                        ), (user_id,)
+                    )
+                    if export_format == "csv":
+                        write_csv_rows(text, columns, rows)
+                    else:
+                        write_json_rows(text, columns, rows)
+    except BaseException:
+        archive.close()
+        raise
+    return archive
+
+def write_csv_rows(text, columns, rows):
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([value.isoformat() if isinstance(value, datetime.datetime) else value for value in row])
+
+# A JSON array written a row at a time rather than built up with json.dump
+def write_json_rows(text, columns, rows):
+    text.write("[")
+    for index, row in enumerate(rows):
+        record = {column: value.isoformat() if isinstance(value, datetime.datetime) else value for column, value in zip(columns, row)}
+        text.write("\n" if index == 0 else ",\n")
+        text.write(json.dumps(record, ensure_ascii=False))
+    text.write("\n]\n")
+
+JOURNAL_SEARCH_PAGE_SIZE = 5
+JOURNAL_SEARCH_PAGE = re.compile(r"^#(\d+)$")
+
+# Ranks a user's journal entries against the search terms using the search
+# column and its GIN index, returning one page of (value, created_at) along
+# with the total number of matches
+def search_journal(user_id, terms, start_date=None, page=1):
+    query = "SELECT value, created_at, COUNT(*) OVER () "\
+            "FROM journal, plainto_tsquery('pg_catalog.english', $2) AS terms "\
+            "WHERE id = $1 AND search @@ terms"
+    params = [user_id, terms]
+    if start_date is not None:
+        params.append(start_date)
+        query += " AND created_at > $3"
+    query += " ORDER BY ts_rank(search, terms) DESC, created_at DESC LIMIT ${} OFFSET ${}".format(len(params) + 1, len(params) + 2)
+    params += [JOURNAL_SEARCH_PAGE_SIZE, (page - 1) * JOURNAL_SEARCH_PAGE_SIZE]
+
+    with transaction() as cursor:
+        execute_prepared(cursor, query, params)
+        rows = cursor.fetchall()
+    total = rows[0][2] if rows else 0
+    return [(value, created_at) for value, created_at, _ in rows], total
+
+def journalsearch(bot, update):
+    user_id = update.message.from_user.id
+    username = get_name(update.message.from_user)
+    parts = [part for part in update.message.text.split(" ")[1:] if part]
+    delete_message(bot, update.message.chat.id, update.message.message_id)
+
+    page = 1
+    if parts and JOURNAL_SEARCH_PAGE.match(parts[-1]):
+        page = max(int(parts.pop()[1:]), 1)
+    period = "all"
+    if parts and parts[-1] in PERIOD_DAYS:
+        period = parts.pop()
+    terms = " ".join(parts)
+
+    if not terms:
+        send_message(bot, chat_id=user_id, parse_mode="Markdown",
+                     text="🔎 Please tell me what to search for, eg. `/journalsearch gratitude monthly`")
+        return
+
+    start_date = None
+    if PERIOD_DAYS[period] is not None:
+        start_date = get_x_days_before(datetime.datetime.now(), PERIOD_DAYS[period] - 1)
+    entries, total = search_journal(user_id, terms, start_date=start_date, page=page)
+
+    if not entries:
+        send_message(bot, chat_id=update.message.chat.id, text="📓 {} has no {}journal entries matching \"{}\". 📓".format(
+            username, "more " if total == 0 and page > 1 else "", terms))
+        return
+
+    for entry in entries:
+        send_message(bot, chat_id=update.message.chat.id, text="📓 Journal entry by {}, dated {}: {}".format(username, entry[1].strftime("%a. %d %B %Y %I:%M%p %Z"), entry[0]))
+
+    first = (page - 1) * JOURNAL_SEARCH_PAGE_SIZE + 1
+    footer = "🔎 Entries {}-{} of {} matching \"{}\"".format(first, first + len(entries) - 1, total, terms)
+    if first + len(entries) - 1 < total:
+        footer += ", see more with /journalsearch {} {} #{}".format(terms, period, page + 1)
+    send_message(bot, chat_id=update.message.chat.id, text=footer)
 
 def top(bot, update):
     get_or_create_user(bot, update)
@@ -488,17 +2054,9 @@ def top(bot, update):
         except ValueError:
             pass
 
-    count = min(count, 20)
+    count = min(count, LEADERBOARD_SIZE)
 
-    results = []
-    cursor = get_connection().cursor()
-    cursor.execute("SELECT * FROM users;")
-    users = cursor.fetchall()
-    get_connection().commit()
-    for user in users:
-        results.append((user[1], user[2], user[3], get_streak_of(user[0])))
-    results.sort(key=lambda x: x[3], reverse=True)
-    top_users = results[:count]
+    top_users = get_leaderboard(count)
 
     line = []
     for i, user in enumerate(top_users):
@@ -516,7 +2074,7 @@ def top(bot, update):
 
     message = '\n'.join(line)
     delete_message(bot, update.message.chat.id, update.message.message_id)
-    bot.send_message(chat_id=update.message.chat_id, text=message)
+    send_message(bot, chat_id=update.message.chat_id, text=message)
 
 def streak(bot, update):
     get_or_create_user(bot, update)
@@ -527,7 +2085,59 @@ def streak(bot, update):
     delete_message(bot, update.message.chat.id, update.message.message_id)
 
     name_to_show = get_name(update.message.from_user)
-    bot.send_message(chat_id=update.message.chat.id, text="{} has a meditation streak of {}! {}".format(name_to_show, streak_count, emoji))
+    send_message(bot, chat_id=update.message.chat.id, text="{} has a meditation streak of {}! {}".format(name_to_show, streak_count, emoji))
+
+# The date formats people actually backdate with, which are parsed here rather
+# than by dateparser. dateparser takes milliseconds per call even for a word
+# that is obviously not a date, and many seconds for some numeric strings.
+NUMERIC_DATE = re.compile(r"^(\d{1,2})([-/.])(\d{1,2})\2(\d{4}|\d{2})$")
+NAMED_MONTH_DATE = re.compile(r"^(\d{1,2})[-/. ]?([a-z]+)\.?[-/. ]?(\d{4}|\d{2})$")
+ISO_DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+MONTHS = {
+    "jan": 1, "january": 1, "feb": 2, "february": 2, "mar": 3, "march": 3,
+    "apr": 4, "april": 4, "may": 5, "jun": 6, "june": 6, "jul": 7, "july": 7,
+    "aug": 8, "august": 8, "sep": 9, "sept": 9, "september": 9, "oct": 10, "october": 10,
+    "nov": 11, "november": 11, "dec": 12, "december": 12
+}
+RELATIVE_DAYS = {"now": 0, "today": 0, "yesterday": 1, "tomorrow": -1}
+
+def make_date(year, month, day):
+    year = int(year)
+    if year < 100:
+        year += 2000
+    try:
+        return datetime.datetime(year, int(month), int(day))
+    except ValueError:
+        return None
+
+# Parses a date written day first (22-03-2018, 22-MARCH-2018, yesterday) or as
+# an ISO date. Anything else containing a digit goes to dateparser, whose
+# answers are cached per day; a plain word that isn't a relative day is
+# never a date.
+def parse_date(text):
+    text = text.strip().lower()
+
+    if text in RELATIVE_DAYS:
+        return datetime.datetime.now() - datetime.timedelta(days=RELATIVE_DAYS[text])
+    if not any(character.isdigit() for character in text):
+        return None
+
+    match = NUMERIC_DATE.match(text)
+    if match:
+        return make_date(match.group(4), match.group(3), match.group(1))
+    match = NAMED_MONTH_DATE.match(text)
+    if match and match.group(2) in MONTHS:
+        return make_date(match.group(3), MONTHS[match.group(2)], match.group(1))
+    match = ISO_DATE.match(text)
+    if match:
+        return make_date(match.group(1), match.group(2), match.group(3))
+
+    key = (text, datetime.date.today())
+    cached = DATE_CACHE.get(key)
+    if cached is None:
+        cached = (load_dateparser().parse(text, settings={'DATE_ORDER': 'DMY', 'STRICT_PARSING': True}),)
+        DATE_CACHE.put(key, cached)
+    return cached[0]
 
 def delete_and_send(bot, update, validation_callback, success_callback, strings, backdate=None):
     get_or_create_user(bot, update)
@@ -536,7 +2146,7 @@ def delete_and_send(bot, update, validation_callback, success_callback, strings,
     parts = parts[1:]
     parts_len = len(parts)
     if parts_len < 1:
-        bot.send_message(chat_id=update.message.from_user.id, text=strings["wrong_length"])
+        send_message(bot, chat_id=update.message.from_user.id, text=strings["wrong_length"])
         return
 
     #ALLOW A USER TO BACKDATE THEIR RECORD
@@ -545,7 +2155,7 @@ def delete_and_send(bot, update, validation_callback, success_callback, strings,
         #This will allow the user to backdate the message
         #If the parsing fails, they probably didn't try to backdate;
         #instead they entered a real word (or made a typo).
-        backdate = dateparser.parse(parts[-1], settings={'DATE_ORDER': 'DMY', 'STRICT_PARSING': True})
+        backdate = parse_date(parts[-1])
 
         #Stop users from accidentally logging at a time they didn't want.
         #Limit the backdate feature to the last month only.
@@ -560,7 +2170,7 @@ def delete_and_send(bot, update, validation_callback, success_callback, strings,
         else:
             # Error, the backdate was parsed but was not in the appropriate date range
             backdate_err = "The backdated date {} (from `{}`) did not take place in the last month.".format(backdate.date().isoformat(), parts[-1])
-            bot.send_message(chat_id=update.message.from_user.id, text=backdate_err)
+            send_message(bot, chat_id=update.message.from_user.id, text=backdate_err)
             return
 
     try:
@@ -568,7 +2178,7 @@ def delete_and_send(bot, update, validation_callback, success_callback, strings,
         if value is False:
             return
     except ValueError:
-        bot.send_message(chat_id=update.message.from_user.id, text=strings["value_error"])
+        send_message(bot, chat_id=update.message.from_user.id, text=strings["value_error"])
         return
 
     if backdate is None:
@@ -582,31 +2192,32 @@ def delete_and_send(bot, update, validation_callback, success_callback, strings,
 
 def get_or_create_user(bot, update):
     user = update.message.from_user
-    cursor = get_connection().cursor()
-
-    cursor.execute('SELECT * FROM users WHERE id = %s', (user.id,))
-    result = cursor.fetchone()
-
-    if result is None:
-        values = []
-        for attribute in ['id', 'first_name', 'last_name', 'username']:
-            value = getattr(user, attribute, None)
-            values.append(value)
-
-        # If command was run in public, ask them to PM us!
-        if update.message.chat_id is not update.message.from_user.id:
-            bot.send_message(chat_id=update.message.chat_id, text="Hey {}! Please message me at @zenafbot so that I can PM you!".format(get_name(user)))
-            values.append(False)
-        else:
-            values.append(True)
+    cached = USER_CACHE.get(user.id)
+    if cached is not None and (cached.first_name, cached.last_name, cached.username) == (user.first_name, user.last_name, user.username):
+        return cached
+
+    # A miss, or the user renamed themselves. Either way a single upsert
+    # brings the row up to date and hands it back; xmax is only 0 for a row
+    # this statement inserted rather than updated.
+    haspm = update.message.chat_id == update.message.from_user.id
+    with transaction() as cursor:
+        execute_prepared(
+            cursor,
+            "INSERT INTO users (id, first_name, last_name, username, haspm) VALUES ($1, $2, $3, $4, $5) "\
+            "ON CONFLICT (id) DO UPDATE SET "\
+            "first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name, username = EXCLUDED.username "\
+            "RETURNING id, first_name, last_name, username, haspm, xmax = 0",
+            (user.id, user.first_name, user.last_name, user.username, haspm)
+        )
+        row = cursor.fetchone()
 
-        cursor.execute("INSERT INTO users(id, first_name, last_name, username, haspm) VALUES (%s, %s, %s, %s, %s)", values)
+    result = User(*row[:5])
+    USER_CACHE.put(result.id, result)
 
-        cursor.execute('SELECT * FROM users WHERE id = %s', (user.id,))
-        result = cursor.fetchone()
+    # If command was run in public, ask them to PM us!
+    if row[5] and not haspm:
+        send_message(bot, chat_id=update.message.chat_id, text="Hey {}! Please message me at @zenafbot so that I can PM you!".format(get_name(user)))
 
-    get_connection().commit()
-    cursor.close()
     return result
 
 def get_name(user):
@@ -616,105 +2227,106 @@ def get_name(user):
 def get_x_days_before(start_date, days_before):
     return start_date - datetime.timedelta(days=days_before)
 
+PERIOD_DAYS = {"weekly": 7, "biweekly": 14, "monthly": 31, "all": None}
+
+STATS_CHARTS = {
+    "/meditatestats": ("meditation", {}),
+    "/anxietystats": ("anxiety", {"line": True}),
+    "/sleepstats": ("sleep", {"calc_average": True}),
+    "/groupstats": ("meditation", {"all_data": True}),
+    "/happinessstats": ("happiness", {"line": True}),
+    "/happystats": ("happiness", {"line": True}),
+    "/fastingstats": ("fasting", {}),
+    "/totalstats": ("happiness", {"line": True, "extra": "anxiety"}),
+}
+
 def stats(bot, update):
     get_or_create_user(bot, update)
     parts = update.message.text.split(' ')
     command = parts[0].split("@")[0]
     user = update.message.from_user
 
+    if command not in STATS_CHARTS:
+        return
+    table, options = STATS_CHARTS[command]
+
+    # Default to a week ago
+    period = parts[1] if len(parts) == 2 and parts[1] in PERIOD_DAYS else "weekly"
     now = datetime.datetime.now()
-    if len(parts) == 2:
-        if parts[1] == 'weekly':
-            start_date = get_x_days_before(now, 7 - 1)
-        elif parts[1] == 'biweekly':
-            start_date = get_x_days_before(now, 14 - 1)
-        elif parts[1] == 'monthly':
-            start_date = get_x_days_before(now, 31 - 1)
-        elif parts[1] == 'all':
-            # Unbounded search for all dates
-            start_date = None
+    if PERIOD_DAYS[period] is None:
+        # Unbounded search for all dates
+        start_date = None
     else:
-        # Default to a week ago
-        start_date = get_x_days_before(now, 7 - 1)
-
-    filename = "./{}-chart.png".format(user.id)
-    if command == "/meditatestats":
-        generate_graph("meditation", filename, user, start_date, now)
-    elif command == "/anxietystats":
-        generate_graph("anxiety", filename, user, start_date, now, line=True)
-    elif command == "/sleepstats":
-        generate_graph("sleep", filename, user, start_date, now, calc_average=True)
-    elif command == "/groupstats":
-        generate_graph("meditation", filename, user, start_date, now, all_data=True)
-    elif command in ("/happinessstats", "/happystats"):
-        generate_graph("happiness", filename, user, start_date, now, line=True)
-    elif command == "/fastingstats":
-        generate_graph("fasting", filename, user, start_date, now)
-    elif command == "/totalstats":
-        generate_graph("happiness", filename, user, start_date, now, line=True, extra="anxiety")
+        start_date = get_x_days_before(now, PERIOD_DAYS[period] - 1)
 
     delete_message(bot, update.message.chat.id, update.message.message_id)
 
-    with open(filename, 'rb') as photo:
-        bot.send_photo(chat_id=update.message.chat_id, photo=photo)
-    # Telegram API is synchronous, so it's OK to clean up now!
-    os.remove(filename)
-
-def gen_data_collection(results):
-    dates_to_value_mapping = defaultdict(int)
-    for result in results:
-        dates_to_value_mapping[result[2].date()] += result[1]
+    # The same chart only needs drawing again once new data is logged for it,
+    # or the day rolls over and moves the period along
+    user_id = None if options.get("all_data") else user.id
+    extra = options.get("extra")
+    cache_key = (
+        table, extra, user_id, get_name(user) if user_id else None, period, now.date(),
+        get_data_version(table, user_id), get_data_version(extra, user_id) if extra else None
+    )
+    chat_id = update.message.chat_id
+    cached = CHART_CACHE.get(cache_key)
+    if cached is not None:
+        send_photo(bot, chat_id=chat_id, photo=io.BytesIO(cached) if isinstance(cached, bytes) else cached)
+        return
 
-    return dates_to_value_mapping.keys(), dates_to_value_mapping.values()
+    # Sent from the render thread once the chart is ready so that this worker
+    # is free to pick up the next update in the meantime. Once Telegram has
+    # the photo, its file_id is all that's needed to send it again.
+    def remember_file_id(message):
+        if message is not None and message.photo:
+            CHART_CACHE.put(cache_key, message.photo[-1].file_id)
+    def send_chart(future):
+        png = future.result()
+        CHART_CACHE.put(cache_key, png)
+        send_photo(bot, callback=remember_file_id, chat_id=chat_id, photo=io.BytesIO(png))
+    future = generate_graph(table, user, start_date, now, **options)
+    if future is None:
+        send_message(bot, chat_id=chat_id, text="There's nothing logged for that period yet!")
+        return
+    future.add_done_callback(send_chart)
 
-def generate_graph(table, filename, user, start_date, end_date, all_data=False, calc_average=False, line=False, extra=None):
+# Queries the data for a chart and queues it up for rendering, returning a
+# future that resolves to the PNG bytes, or None when there's nothing to plot.
+# Bar charts show each day's total and line charts each day's mean, both read
+# from the daily rollups.
+def generate_graph(table, user, start_date, end_date, all_data=False, calc_average=False, line=False, extra=None):
     user_id = None if all_data else user.id
     username = "Group" if all_data else get_name(user)
-    results = get_values(table, start_date=start_date, end_date=end_date, user_id=user_id)
-
-    if extra is not None:
-        results2 = get_values(extra, start_date=start_date, end_date=end_date, user_id=user_id)
 
-    if line:
-        results = sorted(results, key=lambda x: x[2])
-        dates = [x[2].date() for x in results]
-        values = [x[1] for x in results]
-
-        if extra is not None:
-            result2 = sorted(results2, key=lambda x: x[2])
-            dates2 = [x[2].date() for x in results2]
-            values2 = [x[1] for x in results2]
-    else:
-        dates, values = gen_data_collection(results)
+    series = []
+    headlines = []
+    for series_table in (table, extra):
+        if series_table is None:
+            continue
+        days = get_daily_rollups(series_table, start_date=start_date, end_date=end_date, user_id=user_id)
+        totals = [total for _, total, _ in days]
+        if line:
+            series.append(([day for day, _, _ in days], [total / count for _, total, count in days]))
+            # The average of every entry, not of the daily means
+            headlines.append(sum(totals) / max(sum(count for _, _, count in days), 1))
+        else:
+            series.append(([day for day, _, _ in days], totals))
+            headlines.append(sum(totals) / max(len(totals), 1) if calc_average else sum(totals))
 
-    _, axis = plt.subplots()
+    dates, _ = series[0]
+    if not dates:
+        return None
     lower_limit = start_date.date() if start_date else min(dates)
     upper_limit = end_date.date() if end_date else max(dates)
-    axis.set_xlim([lower_limit, upper_limit])
-    axis.xaxis_date()
-    axis.xaxis.set_major_formatter(mdates.DateFormatter('%d/%m'))
-
-    if line:
-        axis.set_ylim([0, 10])
-        sns.lineplot(dates, values)
-
-        if extra is not None:
-            sns.lineplot(dates2, values2)
-    else:
-        plt.bar(dates, values, alpha=0.5)
-
-    sns.despine()
 
     if calc_average or line:
-        title_text = "average: {:.1f}".format(float(sum(values)) / max(len(values), 1))
+        title_text = "average: {:.1f}".format(headlines[0])
     else:
-        title_text = "total: {:.1f}".format(sum(values))
+        title_text = "total: {:.1f}".format(headlines[0])
 
     if extra is not None:
-        if calc_average or line:
-            title_text += " + {:.1f}".format(float(sum(values2)) / max(len(values2), 1))
-        else:
-            title_text += " + {:.1f}".format(sum(values2))
+        title_text += " + {:.1f}".format(headlines[1])
 
     if table == "meditation":
         title_text += " minutes"
@@ -726,101 +2338,310 @@ def generate_graph(table, filename, user, start_date, end_date, all_data=False,
         title_table += " + " + extra
 
     interval = (upper_limit - lower_limit).days + 1
-    plt.title('{}\'s {}\n{} days {}'.format(username, title_table, interval, title_text))
-    plt.savefig(filename)
-    plt.close()
-
-def send_summaries(bot, update):
-    now = datetime.datetime.now()
-    seven_days_ago = get_x_days_before(now, 7)
-
-    cursor = get_connection().cursor()
-    cursor.execute('SELECT * FROM summary WHERE last_emailed < %s', (seven_days_ago,))
-    results = cursor.fetchall()
-
-    for result in results:
-        send_summary_email(result[0])
-        cursor.execute('UPDATE summary SET last_emailed = %s WHERE id = %s', (now, result[0]))
-
-    get_connection().commit()
-    cursor.close()
-
-def send_summary_email(user_id):
-    cursor = get_connection().cursor()
-
-    cursor.execute('SELECT * FROM users WHERE id = %s', (user_id,))
-    user = cursor.fetchone()
-
-    cursor.execute('SELECT * FROM summary WHERE id = %s', (user_id,))
-    result = cursor.fetchone()
-    cursor.close()
-
-    if user is None:
-        return
-
-    if result is None:
-        return
-
-    TO = result[1]
+    title = '{}\'s {}\n{} days {}'.format(username, title_table, interval, title_text)
+    return RENDER_POOL.submit(render_graph, series, lower_limit, upper_limit, title, line)
+
+def render_graph(series, lower_limit, upper_limit, title, line):
+    plotting = load_plotting()
+    figure = plotting.Figure()
+    plotting.FigureCanvasAgg(figure)
+    axis = figure.add_subplot(1, 1, 1)
+    axis.set_xlim([lower_limit, upper_limit])
+    axis.xaxis_date()
+    axis.xaxis.set_major_formatter(plotting.mdates.DateFormatter('%d/%m'))
 
+    if line:
+        axis.set_ylim([0, 10])
+        for dates, values in series:
+            plotting.sns.lineplot(x=dates, y=values, ax=axis)
+    else:
+        dates, values = series[0]
+        axis.bar(dates, values, alpha=0.5)
+
+    plotting.sns.despine(ax=axis)
+    axis.set_title(title)
+
+    output = io.BytesIO()
+    figure.savefig(output, format="png")
+    return output.getvalue()
+
+# Totals for the weekly summary of every matching subscriber in one pass over
+# their daily rollups. Sleep, happiness and anxiety are averaged per day
+# logged, the same way the charts add up several entries on one day.
+SUMMARY_STATS_SQL = \
+    "WITH due AS ("\
+        "SELECT id, email FROM summary WHERE {due_filter}"\
+    "), totals AS ("\
+        "SELECT id, "\
+        "SUM(total) FILTER (WHERE metric = 'meditation') AS meditation_total, "\
+        "AVG(total) FILTER (WHERE metric = 'sleep') AS sleep_mean, "\
+        "AVG(total) FILTER (WHERE metric = 'happiness') AS happiness_mean, "\
+        "AVG(total) FILTER (WHERE metric = 'anxiety') AS anxiety_mean "\
+        "FROM dailyrollups "\
+        "WHERE day >= $1::timestamp::date AND day <= $2::timestamp::date AND id IN (SELECT id FROM due) "\
+        "GROUP BY id"\
+    "), exercises AS ("\
+        "SELECT id, COUNT(*) AS exercise_count FROM exercise "\
+        "WHERE created_at > $1 AND created_at < $2 AND id IN (SELECT id FROM due) "\
+        "GROUP BY id"\
+    ")"\
+    "SELECT due.id, due.email, users.first_name, totals.meditation_total, "\
+    "CASE WHEN streaks.last_day >= current_date - 1 THEN streaks.streak ELSE 0 END, "\
+    "COALESCE(exercises.exercise_count, 0), totals.sleep_mean, totals.happiness_mean, totals.anxiety_mean "\
+    "FROM due JOIN users ON users.id = due.id "\
+    "LEFT JOIN totals ON totals.id = due.id "\
+    "LEFT JOIN exercises ON exercises.id = due.id "\
+    "LEFT JOIN streaks ON streaks.id = due.id"
+
+SummaryStats = namedtuple("SummaryStats", [
+    "id", "email", "first_name", "meditation_total", "streak",
+    "exercise_count", "sleep_mean", "happiness_mean", "anxiety_mean"
+])
+
+# Returns the summary stats between start_date and end_date for user_id, or
+# for every subscriber whose last summary was emailed before due_before and
+# who has no summary still waiting in the outbox
+def get_summary_stats(start_date, end_date, user_id=None, due_before=None):
+    if user_id is not None:
+        query = SUMMARY_STATS_SQL.format(due_filter="id = $3")
+        params = (start_date, end_date, user_id)
+    else:
+        query = SUMMARY_STATS_SQL.format(due_filter=\
+            "last_emailed < $3 AND NOT EXISTS ("\
+                "SELECT 1 FROM emailoutbox WHERE emailoutbox.user_id = summary.id "\
+                "AND emailoutbox.kind = 'summary' AND emailoutbox.sent_at IS NULL AND emailoutbox.attempts < $4"\
+            ")")
+        params = (start_date, end_date, due_before, MAIL_MAX_ATTEMPTS)
+
+    with transaction() as cursor:
+        execute_prepared(cursor, query, params)
+        return [SummaryStats(*row) for row in cursor.fetchall()]
+
+def build_summary_email(stats):
     def f(output):
         return "{:.2f}".format(output)
 
-    def mean(results):
-        _, values = gen_data_collection(results)
-        return float(sum(values)) / max(len(values), 1)
-
-    now = datetime.datetime.now()
-    seven_days_ago = get_x_days_before(now, 7).replace(hour=0, minute=0, second=0)
     body = ""
 
-    meditation_events = get_values("meditation", start_date=seven_days_ago, end_date=now, user_id=user_id)
-    if len(meditation_events) != 0:
-        meditation_sum = f(sum([v[1] for v in meditation_events]))
-        body += "🙏 Meditated "+meditation_sum+" total minutes\n"
+    if stats.meditation_total is not None:
+        body += "🙏 Meditated "+f(stats.meditation_total)+" total minutes\n"
 
-    meditation_streak = str(get_streak_of(user_id))
-    body += "🔥 Meditation streak is at "+meditation_streak+" days in a row\n"
+    body += "🔥 Meditation streak is at "+str(stats.streak or 0)+" days in a row\n"
 
-    exercise_events = get_values("exercise", start_date=seven_days_ago, end_date=now, user_id=user_id)
-    exercise_events_len = str(len(exercise_events))
-    body += "💪 Exercised "+exercise_events_len+" times\n"
+    body += "💪 Exercised "+str(stats.exercise_count)+" times\n"
 
-    sleep_events = get_values("sleep", start_date=seven_days_ago, end_date=now, user_id=user_id)
-    if len(sleep_events) != 0:
-        sleep_mean = f(mean(sleep_events))
-        body += "😴 Slept on average "+sleep_mean+" hours per night\n"
+    if stats.sleep_mean is not None:
+        body += "😴 Slept on average "+f(stats.sleep_mean)+" hours per night\n"
 
-    happiness_events = get_values("happiness", start_date=seven_days_ago, end_date=now, user_id=user_id)
-    if len(happiness_events) != 0:
-        happiness_mean = f(mean(happiness_events))
-        body += "🙂 Average happiness level was "+happiness_mean+"\n"
+    if stats.happiness_mean is not None:
+        body += "🙂 Average happiness level was "+f(stats.happiness_mean)+"\n"
 
-    anxiety_events = get_values("anxiety", start_date=seven_days_ago, end_date=now, user_id=user_id)
-    if len(anxiety_events) != 0:
-        anxiety_mean = f(mean(anxiety_events))
-        body += "😅 Average anxiety level was "+anxiety_mean+"\n"
+    if stats.anxiety_mean is not None:
+        body += "😅 Average anxiety level was "+f(stats.anxiety_mean)+"\n"
 
-    text = "Hi "+user[1]+"!\n\nHere are your logged stats for the last seven days:\n\n"+body+"\n\
+    return "Hi "+stats.first_name+"!\n\nHere are your logged stats for the last seven days:\n\n"+body+"\n\
 Remember, you can log a multitude of things using the bot - check out /help for more details!\n\n\
 ❤️  Mindful Makers\n\
 https://mindfulmakers.club/"
 
-    server = smtplib.SMTP('smtp.gmail.com', 587)
-    server.ehlo()
-    server.starttls()
-    server.login(GMAIL_EMAIL, GMAIL_PASSWORD)
+# Puts a summary email in the outbox for each of the given stats. Delivering
+# one of kind "summary" marks the user's weekly summary as done as of
+# `as_of`, the time the weekly job ran, so next week's run still finds it due.
+def queue_summary_emails(summaries, kind, as_of=None):
+    rows = [(stats.id, stats.email, "⛩ Weekly Summary", build_summary_email(stats), kind, as_of) for stats in summaries]
+    if not rows:
+        return 0
+
+    with transaction() as cursor:
+        execute_values(
+            cursor,
+            "INSERT INTO emailoutbox (user_id, recipient, subject, body, kind, as_of) VALUES %s",
+            rows,
+            page_size=1000
+        )
+    return len(rows)
 
-    try:
-        message = MIMEText(text.encode("UTF-8"), 'plain', "UTF-8")
+def summary_window(now):
+    return get_x_days_before(now, 7).replace(hour=0, minute=0, second=0), now
+
+def send_summaries(bot, update):
+    started = time.perf_counter()
+    now = datetime.datetime.now()
+    start_date, end_date = summary_window(now)
+
+    summaries = get_summary_stats(start_date, end_date, due_before=get_x_days_before(now, 7))
+    queued = queue_summary_emails(summaries, "summary", as_of=now)
+    MAILER.wake()
+    LOGGER.info("Queued %d weekly summaries in %.2fs", queued, time.perf_counter() - started)
+
+# Delivers the emailoutbox table in the background. Messages are sent in
+# parallel by up to MAIL_WORKERS threads, each keeping its own logged-in SMTP
+# session open across messages. Failures are retried with a growing delay
+# until MAIL_MAX_ATTEMPTS is reached.
+class Mailer:
+    def __init__(self, workers, batch_size, poll_interval, max_attempts):
+        self._workers = workers
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._sessions = threading.local()
+        self._open_sessions = set()
+        self._open_sessions_lock = threading.Lock()
+        self._unrecorded = []
+        self._unrecorded_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mailer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="mailer") as executor:
+            while not self._stopping.is_set():
+                try:
+                    # Claiming again before these are recorded could lease
+                    # an already-sent email out a second time
+                    if not self._record_unrecorded():
+                        raise RuntimeError("Sent emails could not be marked as sent")
+                    emails = self.claim()
+                    if emails:
+                        # Wait for the batch so a slow server can't pile up claims
+                        list(executor.map(self.deliver, emails))
+                        continue
+                except Exception:
+                    LOGGER.exception("Mailer failed to process the outbox")
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
+
+        if not self._record_unrecorded():
+            LOGGER.error("Emails %s were sent but could not be marked as sent",
+                         ", ".join(str(sent[0]) for sent in self._unrecorded))
+
+        with self._open_sessions_lock:
+            servers = list(self._open_sessions)
+        for server in servers:
+            self._quit(server)
+
+    # Leases a batch of due emails. Bumping next_attempt_at means a crashed
+    # delivery is picked up again later rather than lost.
+    def claim(self):
+        with transaction() as cursor:
+            execute_prepared(
+                cursor,
+                "UPDATE emailoutbox SET attempts = attempts + 1, next_attempt_at = now() + interval '15 minutes' "\
+                "WHERE id IN ("\
+                    "SELECT id FROM emailoutbox "\
+                    "WHERE sent_at IS NULL AND attempts < $1 AND next_attempt_at <= now() "\
+                    "ORDER BY id LIMIT $2 FOR UPDATE SKIP LOCKED"\
+                ") RETURNING id, user_id, recipient, subject, body, kind, attempts, as_of",
+                (self._max_attempts, self._batch_size)
+            )
+            return cursor.fetchall()
+
+    def deliver(self, email):
+        email_id, user_id, recipient, subject, body, kind, attempts, as_of = email
+        message = MIMEText(body.encode("UTF-8"), 'plain', "UTF-8")
         message["From"] = "Mindful Makers <"+GMAIL_EMAIL+">"
-        message["To"] = TO
-        message["Subject"] = "⛩ Weekly Summary"
-        server.sendmail(GMAIL_EMAIL, [TO], message.as_string())
-    except Exception as exception:
-        print(exception)
+        message["To"] = recipient
+        message["Subject"] = subject
+
+        try:
+            try:
+                self._session().sendmail(GMAIL_EMAIL, [recipient], message.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # The server dropped an idle session; one fresh attempt
+                self._close_session()
+                self._session().sendmail(GMAIL_EMAIL, [recipient], message.as_string())
+        except (smtplib.SMTPException, OSError) as error:
+            LOGGER.warning("Sending email %d to %s failed (attempt %d): %s", email_id, recipient, attempts, error)
+            if not isinstance(error, smtplib.SMTPResponseException):
+                self._close_session()
+            with transaction() as cursor:
+                cursor.execute(
+                    "UPDATE emailoutbox SET last_error = %s, next_attempt_at = now() + %s * interval '1 minute' WHERE id = %s",
+                    (str(error), 2 ** attempts, email_id)
+                )
+            return False
+
+        try:
+            self._record_sent(email_id, user_id, kind, as_of)
+        except (psycopg2.Error, pool.PoolError):
+            # Kept in memory and recorded before the next claim, rather than
+            # left for the lease to expire and the email to go out again
+            LOGGER.exception("Marking email %d as sent failed, will retry", email_id)
+            with self._unrecorded_lock:
+                self._unrecorded.append((email_id, user_id, kind, as_of))
+        return True
+
+    def _record_sent(self, email_id, user_id, kind, as_of):
+        with transaction() as cursor:
+            cursor.execute("UPDATE emailoutbox SET sent_at = now(), last_error = NULL WHERE id = %s", (email_id,))
+            if kind == "summary":
+                cursor.execute("UPDATE summary SET last_emailed = %s WHERE id = %s", (as_of, user_id))
+
+    # Returns whether every delivered email is now marked as sent
+    def _record_unrecorded(self):
+        with self._unrecorded_lock:
+            pending, self._unrecorded = self._unrecorded, []
+        for index, sent in enumerate(pending):
+            try:
+                self._record_sent(*sent)
+            except (psycopg2.Error, pool.PoolError):
+                LOGGER.exception("Marking email %d as sent failed, will retry", sent[0])
+                with self._unrecorded_lock:
+                    self._unrecorded[:0] = pending[index:]
+                return False
+        return True
+
+    def _session(self):
+        server = getattr(self._sessions, "server", None)
+        if server is None:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+            server.ehlo()
+            if SMTP_STARTTLS:
+                server.starttls()
+                server.ehlo()
+            if SMTP_LOGIN:
+                server.login(GMAIL_EMAIL, GMAIL_PASSWORD)
+            self._sessions.server = server
+            with self._open_sessions_lock:
+                self._open_sessions.add(server)
+        return server
+
+    def _close_session(self):
+        server = getattr(self._sessions, "server", None)
+        self._sessions.server = None
+        if server is not None:
+            self._quit(server)
+
+    def _quit(self, server):
+        with self._open_sessions_lock:
+            self._open_sessions.discard(server)
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+MAILER = Mailer(MAIL_WORKERS, MAIL_BATCH_SIZE, MAIL_POLL_INTERVAL, MAIL_MAX_ATTEMPTS)
 
-    server.quit()
+def update_leaderboard(bot, job):
+    refresh_leaderboard()
+
+def repair_streaks(bot, job):
+    for user_id, stored, expected in check_streak_consistency(repair=True):
+        LOGGER.warning("Repaired streak of %s: stored %s, expected %s", user_id, stored, expected)
 
 # Returns number of seconds until xx:00:00.
 # If currently 11:43:23, then should return 37 + 60 * 16
@@ -830,109 +2651,244 @@ def time_until_next_hour():
 
 #######################################################################################
 
-CURSOR = get_connection().cursor()
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS users(\
-    id INTEGER UNIQUE NOT NULL,\
-    first_name text NOT NULL,\
-    last_name text,\
-    username text,\
-    haspm boolean DEFAULT FALSE\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS meditation(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS meditationreminders(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    midnight INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS anxiety(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS sleep(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value REAL NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS fasting(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value REAL NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS happiness(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS journal(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value varchar(4096) NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS exercise(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value varchar(4096) NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS done(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value varchar(4096) NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-CURSOR.execute("CREATE TABLE IF NOT EXISTS summary(\
-    id INTEGER UNIQUE NOT NULL REFERENCES users(id),\
-    email varchar(128) NOT NULL,\
-    last_emailed TIMESTAMP NOT NULL DEFAULT 'epoch',\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-get_connection().commit()
-CURSOR.close()
-
-DISPATCHER.add_handler(CommandHandler('anxiety', anxiety))
-DISPATCHER.add_handler(CommandHandler('anxietystats', stats))
-DISPATCHER.add_handler(CommandHandler('done', done))
-DISPATCHER.add_handler(CommandHandler('exercise', exercise))
-DISPATCHER.add_handler(CommandHandler('fast', fasting))
-DISPATCHER.add_handler(CommandHandler('fasting', fasting))
-DISPATCHER.add_handler(CommandHandler('fastingstats', stats))
-DISPATCHER.add_handler(CommandHandler('groupstats', stats))
-DISPATCHER.add_handler(CommandHandler('happinessstats', stats))
-DISPATCHER.add_handler(CommandHandler('happiness', happiness))
-DISPATCHER.add_handler(CommandHandler('happystats', stats))
-DISPATCHER.add_handler(CommandHandler('help', help_message))
-DISPATCHER.add_handler(CommandHandler('journal', journaladd))
-DISPATCHER.add_handler(CommandHandler('journalentries', journallookup))
-DISPATCHER.add_handler(CommandHandler('meditate', meditate))
-DISPATCHER.add_handler(CommandHandler('meditation', meditate))
-DISPATCHER.add_handler(CommandHandler('meditatestats', stats))
-DISPATCHER.add_handler(CommandHandler('reminders', schedulereminders))
-DISPATCHER.add_handler(CommandHandler('rest', rest))
-DISPATCHER.add_handler(CommandHandler('sleep', sleep))
-DISPATCHER.add_handler(CommandHandler('sleepstats', stats))
-DISPATCHER.add_handler(CommandHandler('streak', streak))
-DISPATCHER.add_handler(CommandHandler('summary', summary))
-DISPATCHER.add_handler(CommandHandler('totalstats', stats))
-DISPATCHER.add_handler(MessageHandler(Filters.private, private_message))
-
-JOBQUEUE.run_repeating(executereminders, interval=3600, first=time_until_next_hour()+10)
-JOBQUEUE.run_daily(send_summaries, time=datetime.time(18, 0, 0), days=(6,))
-
-UPDATER.start_polling()
-UPDATER.idle()
+# Each migration is a version number and its steps. A step is either a SQL
+# statement, an Index, or a function taking a cursor. Migrations containing
+# an Index are run outside of a transaction so the index can be built with
+# CREATE INDEX CONCURRENTLY and not lock a live table.
+MIGRATIONS = [
+    (1, [
+        "CREATE TABLE IF NOT EXISTS users(\
+            id INTEGER UNIQUE NOT NULL,\
+            first_name text NOT NULL,\
+            last_name text,\
+            username text,\
+            haspm boolean DEFAULT FALSE\
+        );",
+        "CREATE TABLE IF NOT EXISTS meditation(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value INTEGER NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS meditationreminders(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value INTEGER NOT NULL,\
+            midnight INTEGER NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS anxiety(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value INTEGER NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS sleep(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value REAL NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS fasting(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value REAL NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS happiness(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value INTEGER NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS journal(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value varchar(4096) NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS exercise(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value varchar(4096) NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS done(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            value varchar(4096) NOT NULL,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        "CREATE TABLE IF NOT EXISTS summary(\
+            id INTEGER UNIQUE NOT NULL REFERENCES users(id),\
+            email varchar(128) NOT NULL,\
+            last_emailed TIMESTAMP NOT NULL DEFAULT 'epoch',\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+    ]),
+    (2, [
+        "CREATE TABLE IF NOT EXISTS streaks(\
+            id INTEGER UNIQUE NOT NULL REFERENCES users(id),\
+            streak INTEGER NOT NULL DEFAULT 0,\
+            last_day DATE\
+        );",
+        rebuild_streaks,
+    ]),
+    (3, [Index("{}_id_created_at".format(table), table, ("id", "created_at"), "btree") for table in EVENT_TABLES] + [
+        Index("meditationreminders_value", "meditationreminders", ("value",), "btree"),
+        Index("summary_last_emailed", "summary", ("last_emailed",), "btree"),
+    ]),
+    (4, [
+        "CREATE TABLE IF NOT EXISTS emailoutbox(\
+            id SERIAL PRIMARY KEY,\
+            user_id INTEGER NOT NULL REFERENCES users(id),\
+            recipient varchar(128) NOT NULL,\
+            subject text NOT NULL,\
+            body text NOT NULL,\
+            kind varchar(16) NOT NULL,\
+            attempts INTEGER NOT NULL DEFAULT 0,\
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT now(),\
+            last_error text,\
+            sent_at TIMESTAMP,\
+            created_at TIMESTAMP NOT NULL DEFAULT now()\
+        );",
+        Index("emailoutbox_pending", "emailoutbox", ("sent_at", "next_attempt_at"), "btree"),
+        Index("emailoutbox_user_id", "emailoutbox", ("user_id",), "btree"),
+    ]),
+    (5, [
+        "CREATE TABLE IF NOT EXISTS dailyrollups(\
+            id INTEGER NOT NULL REFERENCES users(id),\
+            metric varchar(16) NOT NULL,\
+            day DATE NOT NULL,\
+            total DOUBLE PRECISION NOT NULL,\
+            count INTEGER NOT NULL,\
+            min DOUBLE PRECISION NOT NULL,\
+            max DOUBLE PRECISION NOT NULL,\
+            last_value DOUBLE PRECISION NOT NULL,\
+            last_at TIMESTAMP NOT NULL,\
+            PRIMARY KEY (id, metric, day)\
+        );",
+        backfill_rollups,
+    ]),
+    (6, [
+        "CREATE TABLE IF NOT EXISTS grouprollups(\
+            metric varchar(16) NOT NULL,\
+            day DATE NOT NULL,\
+            total DOUBLE PRECISION NOT NULL,\
+            count INTEGER NOT NULL,\
+            PRIMARY KEY (metric, day)\
+        );",
+        backfill_group_rollups,
+    ]),
+    # Journal entries get a tsvector of their text for /journalsearch, kept
+    # up to date by a trigger
+    (7, [
+        "ALTER TABLE journal ADD COLUMN IF NOT EXISTS search tsvector;",
+        "DROP TRIGGER IF EXISTS journal_search ON journal;",
+        "CREATE TRIGGER journal_search BEFORE INSERT OR UPDATE OF value ON journal \
+            FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search, 'pg_catalog.english', value);",
+        "UPDATE journal SET search = to_tsvector('pg_catalog.english', value) WHERE search IS NULL;",
+    ]),
+    # Fresh statistics on the new column let the planner combine this index
+    # with journal_id_created_at instead of fetching every user's matches
+    (8, [
+        Index("journal_search", "journal", ("search",), "gin"),
+        "ANALYZE journal;",
+    ]),
+    # The weekly job's own time, which becomes summary.last_emailed once the
+    # summary is delivered
+    (9, [
+        "ALTER TABLE emailoutbox ADD COLUMN IF NOT EXISTS as_of TIMESTAMP;",
+        "UPDATE emailoutbox SET as_of = created_at WHERE kind = 'summary' AND as_of IS NULL;",
+    ]),
+]
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+    configure_slow_query_log()
+
+    started = time.perf_counter()
+    DISPATCHER.add_handler(CommandHandler('anxiety', in_order(anxiety, 'anxiety')))
+    DISPATCHER.add_handler(CommandHandler('anxietystats', in_order(stats, 'anxietystats')))
+    DISPATCHER.add_handler(CommandHandler('done', in_order(done, 'done')))
+    DISPATCHER.add_handler(CommandHandler('exercise', in_order(exercise, 'exercise')))
+    DISPATCHER.add_handler(CommandHandler('export', in_order(export, 'export')))
+    DISPATCHER.add_handler(CommandHandler('fast', in_order(fasting, 'fast')))
+    DISPATCHER.add_handler(CommandHandler('fasting', in_order(fasting, 'fasting')))
+    DISPATCHER.add_handler(CommandHandler('fastingstats', in_order(stats, 'fastingstats')))
+    DISPATCHER.add_handler(CommandHandler('groupstats', in_order(stats, 'groupstats')))
+    DISPATCHER.add_handler(CommandHandler('happinessstats', in_order(stats, 'happinessstats')))
+    DISPATCHER.add_handler(CommandHandler('happiness', in_order(happiness, 'happiness')))
+    DISPATCHER.add_handler(CommandHandler('happystats', in_order(stats, 'happystats')))
+    DISPATCHER.add_handler(CommandHandler('help', in_order(help_message, 'help')))
+    DISPATCHER.add_handler(CommandHandler('journal', in_order(journaladd, 'journal')))
+    DISPATCHER.add_handler(CommandHandler('journalentries', in_order(journallookup, 'journalentries')))
+    DISPATCHER.add_handler(CommandHandler('journalsearch', in_order(journalsearch, 'journalsearch')))
+    DISPATCHER.add_handler(CommandHandler('meditate', in_order(meditate, 'meditate')))
+    DISPATCHER.add_handler(CommandHandler('meditation', in_order(meditate, 'meditation')))
+    DISPATCHER.add_handler(CommandHandler('meditatestats', in_order(stats, 'meditatestats')))
+    DISPATCHER.add_handler(CommandHandler('reminders', in_order(schedulereminders, 'reminders')))
+    DISPATCHER.add_handler(CommandHandler('rest', in_order(rest, 'rest')))
+    DISPATCHER.add_handler(CommandHandler('sleep', in_order(sleep, 'sleep')))
+    DISPATCHER.add_handler(CommandHandler('sleepstats', in_order(stats, 'sleepstats')))
+    DISPATCHER.add_handler(CommandHandler('streak', in_order(streak, 'streak')))
+    DISPATCHER.add_handler(CommandHandler('summary', in_order(summary, 'summary')))
+    DISPATCHER.add_handler(CommandHandler('totalstats', in_order(stats, 'totalstats')))
+    DISPATCHER.add_handler(MessageHandler(Filters.private, in_order(private_message)))
+
+    JOBQUEUE.run_repeating(instrumented_job(executereminders), interval=3600, first=time_until_next_hour()+10)
+    JOBQUEUE.run_daily(instrumented_job(send_summaries), time=datetime.time(18, 0, 0), days=(6,))
+    JOBQUEUE.run_repeating(instrumented_job(update_leaderboard), interval=300, first=0)
+    JOBQUEUE.run_daily(instrumented_job(repair_streaks), time=datetime.time(4, 0, 0), days=(0,))
+    record_startup("register handlers and jobs", started)
+
+    # Start taking updates straight away; they queue up behind the
+    # migrations rather than behind the whole of startup
+    started = time.perf_counter()
+    if MODE == "webhook":
+        UPDATER.start_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                              cert=WEBHOOK_CERT, key=WEBHOOK_KEY, webhook_url=WEBHOOK_URL)
+        # The Updater only registers the webhook itself when it holds the
+        # certificate; behind a proxy it has to be told the public URL
+        if WEBHOOK_CERT is None and WEBHOOK_URL is not None:
+            UPDATER.bot.set_webhook(url=WEBHOOK_URL)
+        record_startup("start webhook server", started)
+    else:
+        UPDATER.start_polling()
+        record_startup("start polling", started)
+
+    started = time.perf_counter()
+    try:
+        init_database()
+    except Exception:
+        UPDATER.stop()
+        raise
+    record_startup("connect and migrate database", started)
+    record_startup("total until ready", STARTUP_STARTED)
+    log_startup_report()
+
+    threading.Thread(target=warm_up, name="warm_up", daemon=True).start()
+    MAILER.start()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+
+    UPDATER.idle()
+    HANDLERS.shutdown()
+    EXPORT_POOL.shutdown()
+    # Charts still rendering send their photo when done, then the outbox's
+    # daemon threads get a chance to deliver what's queued before exit
+    RENDER_POOL.shutdown()
+    if not OUTBOX.wait_until_empty(OUTBOX_DRAIN_TIMEOUT):
+        LOGGER.warning("Shutting down with %d messages still in the outbox", OUTBOX.depth())
+    WRITE_BUFFER.stop()
+    MAILER.stop()
+
+# Recomputes the daily and group rollups from the raw tables, e.g. after
+# rows were changed by hand: python bot.py backfill
+def backfill():
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+    init_database()
+    started = time.perf_counter()
+    with transaction() as cursor:
+        backfill_rollups(cursor)
+        backfill_group_rollups(cursor)
+        cursor.execute("SELECT COUNT(*) FROM dailyrollups")
+        count = cursor.fetchone()[0]
+    LOGGER.info("Rebuilt %d daily rollups in %.2fs", count, time.perf_counter() - started)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["backfill"]:
+        backfill()
+    else:
+        main()
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+
+# End-to-end load test. Runs a local stand-in for the Telegram Bot API, starts
+# the unmodified bot.py against it in long-polling mode, and replays a mix of
+# commands from simulated users at a target rate. Reports throughput,
+# end-to-end latency (from an update being available to the bot's reply) and
+# how the backlog grows, and writes the numbers out as JSON.
+#
+#   python loadtest.py --rate 20 --duration 60 --users 200
+#
+# The bot runs in a scratch directory with a copy of creds.ini where
+# BOT_API_URL points at the stand-in and DB_NAME at a separate database
+# (DB_NAME + "_loadtest" unless --db-name is given).
+# Like benchmark.py, it imports bot.py, so run it from a directory with a
+# creds.ini.
+#
+# The stand-in can also be run on its own for manual testing:
+#
+#   python loadtest.py --serve-only --port 8081
+
+import argparse
+from configparser import ConfigParser
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import signal
+from socketserver import ThreadingMixIn
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark import create_database, percentile
+from bot import TokenBucket
+
+BOT_USERNAME = "zenafbot"
+
+# (weight, command) pairs for the replayed traffic, roughly what a busy
+# morning in the channel looks like
+COMMAND_MIX = [
+    (35, lambda rng: "/meditate {}".format(rng.choice((10, 15, 20, 30, 45)))),
+    (10, lambda rng: "/sleep {}".format(rng.choice((6, 6.5, 7, 7.5, 8)))),
+    (15, lambda rng: "/journal {}".format(rng.choice(("Calm morning sit", "Restless but stayed with it", "Gratitude for the group")))),
+    (15, lambda rng: "/{} {}".format(rng.choice(("meditatestats", "sleepstats", "happinessstats", "groupstats")),
+                                     rng.choice(("weekly", "biweekly", "monthly", "all")))),
+    (10, lambda rng: "/top"),
+    (5, lambda rng: "/streak"),
+    (5, lambda rng: "/reminders {}AM {}PM Europe/Amsterdam".format(rng.randint(6, 11), rng.randint(1, 11))),
+    (5, lambda rng: "/happiness {}".format(rng.randint(0, 10))),
+]
+
+# http.server only gained ThreadingHTTPServer in Python 3.7
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# A minimal Telegram Bot API: getMe, deleteWebhook, getUpdates, sendMessage,
+# sendPhoto, sendDocument and deleteMessage. Sends are delayed by `latency`
+# seconds and answered with 429 flood-control errors when they exceed the
+# global or per-chat rate, like the real API does.
+class FakeBotAPI:
+    def __init__(self, latency, global_rate, chat_rate, flood_probability, on_send=None):
+        self.latency = latency
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.flood_probability = flood_probability
+        self.on_send = on_send
+        self.rng = random.Random(7)
+        self.lock = threading.Lock()
+        self.updates_available = threading.Condition(self.lock)
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1000000
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.counts = {}
+        self.first_poll = threading.Event()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def add_update(self, message):
+        with self.lock:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append({"update_id": update_id, "message": message})
+            self.updates_available.notify_all()
+        return update_id
+
+    def backlog(self):
+        with self.lock:
+            return len(self.updates)
+
+    def get_updates(self, params):
+        self.first_poll.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            # Anything below the offset has been confirmed by the bot
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.updates_available.wait(remaining)
+            return self.updates[:limit]
+
+    # Returns the 429 response for a send over the rate limit, or None
+    def flood_control(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, max(self.chat_rate, 3))
+            buckets = (self.global_bucket, self.chat_buckets[chat_id])
+            wait = max(bucket.delay(now) for bucket in buckets)
+            if wait == 0:
+                for bucket in buckets:
+                    bucket.take(now)
+                if self.rng.random() < self.flood_probability:
+                    wait = 1
+        if wait == 0:
+            return None
+        retry_after = int(math.ceil(wait))
+        return 429, {"ok": False, "error_code": 429,
+                     "description": "Too Many Requests: retry after {}".format(retry_after),
+                     "parameters": {"retry_after": retry_after}}
+
+    def message(self, chat_id, **fields):
+        with self.lock:
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                   "from": {"id": 1, "is_bot": True, "first_name": "Zen", "username": BOT_USERNAME}}
+        message.update(fields)
+        return message
+
+    def handle(self, method, params):
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Zen", "username": BOT_USERNAME}}
+        if method in ("deleteWebhook", "setWebhook"):
+            return 200, {"ok": True, "result": True}
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self.get_updates(params)}
+
+        if method not in ("sendMessage", "sendPhoto", "sendDocument", "deleteMessage"):
+            self.count("unknown " + method)
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+
+        time.sleep(self.latency)
+        chat_id = int(params["chat_id"])
+        if method == "deleteMessage":
+            self.count(method)
+            return 200, {"ok": True, "result": True}
+
+        flood = self.flood_control(chat_id)
+        if flood is not None:
+            self.count("429 " + method)
+            return flood
+
+        self.count(method)
+        if self.on_send is not None:
+            self.on_send(method, chat_id)
+        if method == "sendMessage":
+            return 200, {"ok": True, "result": self.message(chat_id, text=params.get("text", ""))}
+        if method == "sendPhoto":
+            photo = params.get("photo")
+            file_id = photo if isinstance(photo, str) else "photo-{}".format(self.next_message_id)
+            return 200, {"ok": True, "result": self.message(chat_id, photo=[
+                {"file_id": file_id, "width": 320, "height": 240},
+                {"file_id": file_id, "width": 1280, "height": 960},
+            ])}
+        return 200, {"ok": True, "result": self.message(chat_id, document={"file_id": "document-{}".format(self.next_message_id)})}
+
+    def server(self, port):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, response = api.handle(method, parse_params(self.headers.get("Content-Type", ""), body))
+                payload = json.dumps(response).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The bot hung up on a long poll while shutting down
+                    pass
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return ThreadingServer(("127.0.0.1", port), Handler)
+
+# Decodes the JSON or multipart/form-data body of an API call. Uploaded files
+# come back as bytes.
+def parse_params(content_type, body):
+    if content_type.startswith("application/json"):
+        return json.loads(body.decode("utf-8") or "{}")
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            params[name] = payload if part.get_filename() else payload.decode("utf-8")
+        return params
+    return {}
+
+# Keeps track of the updates in flight. Each simulated user has at most one
+# update outstanding, so the next reply sent to their chat is its answer.
+class Tracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outstanding = {}
+        self.latencies = []
+        self.completed_at = []
+        self.late_replies = 0
+
+    def start(self, chat_id, update_id):
+        with self.lock:
+            self.outstanding[chat_id] = (update_id, time.monotonic())
+
+    def busy(self, chat_id):
+        with self.lock:
+            return chat_id in self.outstanding
+
+    def reply(self, method, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            pending = self.outstanding.pop(chat_id, None)
+            if pending is None:
+                self.late_replies += 1
+                return
+            self.latencies.append(now - pending[1])
+            self.completed_at.append(now)
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.outstanding)
+
+def make_update(rng, user_id, message_id):
+    commands, weights = zip(*[(command, weight) for weight, command in COMMAND_MIX])
+    text = rng.choices(commands, weights)[0](rng)
+    user = {"id": user_id, "is_bot": False, "first_name": "User{}".format(user_id)}
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+        "from": user,
+        "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split(" ")[0])}],
+    }
+
+# Starts bot.py in a scratch directory whose creds.ini points at the stand-in
+def start_bot(args, port):
+    parser = ConfigParser()
+    parser.read(args.creds)
+    db_name = args.db_name or parser.get("DEFAULT", "DB_NAME") + "_loadtest"
+    create_database(db_name, parser)
+
+    # Never hand the real token to anything but Telegram
+    parser.set("DEFAULT", "BOT_TOKEN", "123456:LOADTEST")
+    parser.set("DEFAULT", "BOT_API_URL", "http://127.0.0.1:{}/bot".format(port))
+    parser.set("DEFAULT", "DB_NAME", db_name)
+    parser.set("DEFAULT", "MODE", "polling")
+    for option in args.set or ():
+        key, _, value = option.partition("=")
+        parser.set("DEFAULT", key.strip(), value.strip())
+
+    directory = tempfile.mkdtemp(prefix="zen-loadtest-")
+    with open(os.path.join(directory, "creds.ini"), "w") as creds:
+        parser.write(creds)
+    log = open(os.path.join(directory, "bot.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")],
+                               cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+    return process, directory, log
+
+def run(args):
+    tracker = Tracker()
+    api = FakeBotAPI(args.api_latency / 1000, args.api_rate, args.chat_rate, args.flood_probability, tracker.reply)
+    server = api.server(args.port)
+    threading.Thread(target=server.serve_forever, name="fake_api", daemon=True).start()
+    port = server.server_address[1]
+
+    process, directory, log = start_bot(args, port)
+    try:
+        deadline = time.monotonic() + args.startup_timeout
+        while not api.first_poll.wait(0.5):
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit("The bot never polled for updates; see {}".format(os.path.join(directory, "bot.log")))
+        print("Bot is polling; replaying {} updates/s from {} users for {}s".format(args.rate, args.users, args.duration))
+
+        rng = random.Random(args.seed)
+        samples = []
+        offered = 0
+        skipped = 0
+        started = time.monotonic()
+        next_sample = started
+        for tick in itertools.count():
+            due = started + tick / args.rate
+            now = time.monotonic()
+            if due - started >= args.duration:
+                break
+            if due > now:
+                time.sleep(due - now)
+
+            idle = [user_id for user_id in rng.sample(range(1, args.users + 1), min(args.users, 20)) if not tracker.busy(user_id)]
+            if not idle:
+                # Every sampled user is still waiting on the bot
+                skipped += 1
+            else:
+                user_id = idle[0]
+                tracker.start(user_id, api.add_update(make_update(rng, user_id, tick + 1)))
+                offered += 1
+
+            if time.monotonic() >= next_sample:
+                samples.append({"t": round(time.monotonic() - started, 1),
+                                "unfetched": api.backlog(), "in_flight": tracker.in_flight()})
+                next_sample += 1
+
+        # Give the bot a chance to catch up before counting what's left
+        drain_deadline = time.monotonic() + args.drain
+        while tracker.in_flight() and time.monotonic() < drain_deadline:
+            time.sleep(0.2)
+        elapsed = time.monotonic() - started
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        server.shutdown()
+
+    latencies = sorted(tracker.latencies)
+    window = [at for at in tracker.completed_at if at - started <= args.duration]
+    backlog = [sample["unfetched"] + sample["in_flight"] for sample in samples]
+    half = len(backlog) // 2
+    report = {
+        "settings": vars(args),
+        "offered": offered,
+        "offered_per_second": offered / args.duration,
+        "skipped_busy_users": skipped,
+        "completed": len(latencies),
+        "completed_per_second": len(window) / args.duration,
+        "unanswered": tracker.in_flight(),
+        "late_replies": tracker.late_replies,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000 if latencies else None,
+            "p95": percentile(latencies, 0.95) * 1000 if latencies else None,
+            "p99": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "max": latencies[-1] * 1000 if latencies else None,
+        },
+        # Positive when the bot falls further behind over the run
+        "backlog_growth_per_second": ((sum(backlog[half:]) / max(len(backlog) - half, 1) - sum(backlog[:half]) / max(half, 1))
+                                      / max(elapsed / 2, 1)) if backlog else None,
+        "backlog_samples": samples,
+        "api_calls": dict(api.counts),
+        "bot_log": os.path.join(directory, "bot.log"),
+    }
+
+    print("Offered {offered} updates ({offered_per_second:.1f}/s), completed {completed} "
+          "({completed_per_second:.1f}/s within the run), {unanswered} unanswered".format(**report))
+    if latencies:
+        print("Latency p50 {p50:.0f}ms  p95 {p95:.0f}ms  p99 {p99:.0f}ms  max {max:.0f}ms".format(**report["latency_ms"]))
+    print("Backlog growth {:.2f} updates/s, max backlog {}".format(report["backlog_growth_per_second"] or 0, max(backlog or [0])))
+    print("API calls: {}".format(", ".join("{} {}".format(key, value) for key, value in sorted(api.counts.items()))))
+
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print("Wrote {}".format(args.output))
+    if not args.keep:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def serve_only(args):
+    api = FakeBotAPI(args.api_latency / 1000, args.api_rate, args.chat_rate, args.flood_probability)
+    server = api.server(args.port)
+    print("Fake Bot API listening on http://127.0.0.1:{}/bot<token>/".format(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a command mix against the bot through a fake Bot API")
+    parser.add_argument("--rate", type=float, default=10, help="updates per second to offer")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to replay for")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=50, help="milliseconds added to every send")
+    parser.add_argument("--api-rate", type=float, default=30, help="sends per second before flood control")
+    parser.add_argument("--chat-rate", type=float, default=1, help="sends per second per chat before flood control")
+    parser.add_argument("--flood-probability", type=float, default=0, help="chance of a random 429 on any send")
+    parser.add_argument("--port", type=int, default=0, help="port for the fake API, default any free one")
+    parser.add_argument("--creds", default="creds.ini", help="config to base the bot's creds.ini on")
+    parser.add_argument("--db-name", default=None)
+    parser.add_argument("--set", action="append", metavar="KEY=VALUE", help="override a setting in the bot's creds.ini")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for replies after the run")
+    parser.add_argument("--keep", action="store_true", help="keep the bot's scratch directory and log")
+    parser.add_argument("--serve-only", action="store_true", help="only run the fake API")
+    parser.add_argument("--output", default="loadtest-results.json")
+    args = parser.parse_args()
+
+    if args.serve_only:
+        serve_only(args)
+    else:
+        run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from configparser import ConfigParser
+import importlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from telegram.error import BadRequest, TimedOut
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# bot.py reads creds.ini from the working directory when it is imported, and
+# the Updater insists on a token that looks real
+def import_bot():
+    parser = ConfigParser()
+    parser.read(os.path.join(ROOT, "creds.example.ini"))
+    parser["DEFAULT"]["BOT_TOKEN"] = "123456:TEST"
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "creds.ini"), "w") as creds:
+        parser.write(creds)
+
+    sys.path.insert(0, ROOT)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return importlib.import_module("bot")
+    finally:
+        os.chdir(cwd)
+
+bot = import_bot()
+
+# Records what was sent, raising the errors queued up for each text
+class FakeBot:
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _call(self, method, kwargs):
+        with self.lock:
+            self.calls += 1
+            key = kwargs.get("text", method)
+            if self.errors.get(key):
+                raise self.errors[key].pop(0)
+            self.sent.append((method, key, time.monotonic()))
+        return key
+
+    def send_message(self, **kwargs):
+        return self._call("send_message", kwargs)
+
+    def delete_message(self, **kwargs):
+        return self._call("delete_message", kwargs)
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.outbox = bot.Outbox(2, 1000, 1000, 1000, 5)
+
+    def test_bad_request_fails_without_retrying(self):
+        fake = FakeBot({"bad": [BadRequest("Chat not found")] * 5})
+        future = self.outbox.put(fake, "send_message", {"chat_id": 1, "text": "bad"})
+
+        self.assertIsInstance(future.exception(timeout=5), BadRequest)
+        self.assertEqual(fake.calls, 1)
+        self.assertEqual(self.outbox.counters["retried"], 0)
+        self.assertEqual(self.outbox.counters["failed"], 1)
+
+    def test_timed_out_is_retried(self):
+        fake = FakeBot({"slow": [TimedOut()]})
+        future = self.outbox.put(fake, "send_message", {"chat_id": 1, "text": "slow"})
+
+        self.assertEqual(future.result(timeout=10), "slow")
+        self.assertEqual(fake.calls, 2)
+        self.assertEqual(self.outbox.counters["retried"], 1)
+
+    def test_retry_keeps_chat_order(self):
+        fake = FakeBot({"first": [TimedOut()]})
+        self.outbox.put(fake, "send_message", {"chat_id": 1, "text": "first"})
+        time.sleep(0.1)
+        self.outbox.put(fake, "send_message", {"chat_id": 1, "text": "second"})
+
+        self.assertTrue(self.outbox.wait_until_empty(10))
+        self.assertEqual([text for _, text, _ in fake.sent], ["first", "second"])
+
+    # As in a group where the bot isn't an admin: the command can't be
+    # deleted, and that mustn't hold up the reply
+    def test_failed_delete_does_not_delay_reply(self):
+        for error in (BadRequest("Message can't be deleted"), TimedOut()):
+            fake = FakeBot({"delete_message": [error] * 5})
+            started = time.monotonic()
+            bot.delete_message(fake, chat_id=-100, message_id=5)
+            reply = bot.send_message(fake, chat_id=-100, text="reply")
+
+            self.assertEqual(reply.result(timeout=5), "reply")
+            self.assertLess(time.monotonic() - started, 1)
+
+if __name__ == "__main__":
+    unittest.main()